@@ -0,0 +1,137 @@
+import os
+import json
+import hashlib
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from clients import in_current_scope
+
+# Concurrent requests and requests per minute allowed per provider (rpm 0 = no limit).
+# Override with e.g. OPENAI_CONCURRENCY=16 / OPENAI_RPM=1000 in the .env file.
+PROVIDER_LIMITS = {
+    'openai': {'concurrency': 8, 'rpm': 500},
+    'anthropic': {'concurrency': 4, 'rpm': 50},
+    'google': {'concurrency': 4, 'rpm': 60},
+    'mistral': {'concurrency': 2, 'rpm': 60},
+    'ollama': {'concurrency': 1, 'rpm': 0},  # Local models answer one request at a time
+}
+
+class ProviderLimiter:
+    """Caps in-flight calls and calls per minute for one provider across all threads."""
+
+    def __init__(self, concurrency=1, rpm=0):
+        self.concurrency = max(1, concurrency)
+        self.rpm = rpm
+        self._slots = threading.BoundedSemaphore(self.concurrency)
+        self._lock = threading.Lock()
+        self._sent = deque()
+
+    def _wait_for_rate(self):
+        if not self.rpm:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._sent and now - self._sent[0] >= 60:
+                    self._sent.popleft()
+                if len(self._sent) < self.rpm:
+                    self._sent.append(now)
+                    return
+                delay = 60 - (now - self._sent[0])
+            time.sleep(delay)
+
+    def call(self, fn, *args, **kwargs):
+        with self._slots:
+            self._wait_for_rate()
+            return fn(*args, **kwargs)
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_limiter(dev):
+    # One limiter per provider, shared by every batch in the session
+    with _limiters_lock:
+        if dev not in _limiters:
+            limits = PROVIDER_LIMITS.get(dev, {'concurrency': 1, 'rpm': 0})
+            concurrency = int(os.environ.get(f"{dev.upper()}_CONCURRENCY", limits['concurrency']))
+            rpm = int(os.environ.get(f"{dev.upper()}_RPM", limits['rpm']))
+            _limiters[dev] = ProviderLimiter(concurrency, rpm)
+        return _limiters[dev]
+
+def run_concurrent(dev, jobs):
+    """Run (key, fn, args, kwargs) jobs under the provider's limits, yielding (key, result, error) as each completes.
+
+    jobs may be a generator; finished calls are handed back while it is still producing.
+    At most twice the provider's concurrency are submitted but unfinished, so
+    jobs (and what they carry) are only pulled as calls complete. Closing this
+    generator cancels every call that has not started yet.
+    """
+    limiter = get_limiter(dev)
+    max_pending = 2 * limiter.concurrency
+    done = queue.Queue()
+    futures = {}
+
+    def collect(future):
+        key = futures.pop(future)
+        try:
+            return key, future.result(), None
+        except Exception as e:
+            return key, None, e
+
+    executor = ThreadPoolExecutor(max_workers=limiter.concurrency)
+    try:
+        for key, fn, args, kwargs in jobs:
+            # Calls see the caller's ClientScope, so cancelling the request aborts them
+            future = executor.submit(in_current_scope(limiter.call), fn, *args, **kwargs)
+            futures[future] = key
+            future.add_done_callback(done.put)
+            while not done.empty():
+                yield collect(done.get())
+            while len(futures) >= max_pending:
+                yield collect(done.get())
+        while futures:
+            yield collect(done.get())
+    finally:
+        # When the caller stops early, queued calls are dropped and running ones are abandoned
+        executor.shutdown(wait=False, cancel_futures=True)
+        if hasattr(jobs, 'close'):
+            jobs.close()
+
+class BatchCheckpoint:
+    """Append-only JSONL log of batch answers, one file per batch directory.
+
+    Each record is keyed by the file's path and content hash, the prompt,
+    provider, model, options and the context text hash, so re-running a batch
+    skips files that were already answered with the same inputs.
+    """
+
+    def __init__(self, directory, checkpoint_dir="batch_results"):
+        self.directory = os.path.abspath(directory)
+        name = hashlib.sha1(self.directory.encode()).hexdigest()[:16]
+        self.path = os.path.join(checkpoint_dir, f"{name}.jsonl")
+
+    @staticmethod
+    def record_key(file_name, file_hash, prompt, dev, model_name, max_tokens, include_chat_history, image_skip, context_hash):
+        key_data = json.dumps([file_name, file_hash, prompt, dev, model_name, max_tokens, include_chat_history, image_skip, context_hash])
+        return hashlib.sha256(key_data.encode()).hexdigest()
+
+    def iter_records(self):
+        # Read line by line so the log is never held in memory
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # A line cut short by a crash
+        except FileNotFoundError:
+            return
+
+    def append(self, key, file_path, response):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        record = {"key": key, "file": file_path, "response": response, "time": time.time()}
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
@@ -0,0 +1,54 @@
+"""Per-prompt overhead of loading the context directory.
+
+Builds a context directory of text files, warms the on-disk context cache,
+then times AIPlayground._extract_context the way each prompt calls it.
+
+    python bench/context_overhead.py [files] [runs]
+"""
+import contextlib
+import io
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import model_interact
+from prep_file import context_directory
+
+WORDS = ["alpha", "beta", "gamma", "delta", "epsilon", "zeta"]
+
+def make_context(directory, files, words_per_file=2000):
+    random.seed(0)
+    for i in range(files):
+        with open(os.path.join(directory, f"doc{i}.txt"), "w") as f:
+            f.write(" ".join(random.choice(WORDS) for _ in range(words_per_file)))
+
+def main():
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    work = tempfile.mkdtemp()
+    # The context cache and history files are written to the working directory
+    os.chdir(work)
+    context_dir = os.path.join(work, "context")
+    os.makedirs(context_dir)
+    make_context(context_dir, files)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        context_directory(context_dir, use_cache=True)
+        playground = model_interact.AIPlayground(context_dir=context_dir, history_file="history.json")
+
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            context = playground._extract_context(True)
+        times.append(time.perf_counter() - start)
+    print(f"{len(context or {})} files in context, per prompt median {statistics.median(times) * 1000:.1f} ms "
+          f"(min {min(times) * 1000:.1f} ms, max {max(times) * 1000:.1f} ms)")
+
+if __name__ == "__main__":
+    main()
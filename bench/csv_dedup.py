@@ -0,0 +1,39 @@
+"""Time extract_json_text on a large CSV, with and without containment checks.
+
+Writes a CSV of random rows (an id and six words from a 5,000-word
+vocabulary) and extracts it with the default exact dedup and with
+check_similar=True.
+
+    python bench/csv_dedup.py [rows]
+"""
+import csv
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from read_json_text import extract_json_text
+
+def make_csv(path, rows):
+    random.seed(0)
+    words = [f"w{i}" for i in range(5000)]
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        for i in range(rows):
+            writer.writerow([i] + random.sample(words, 6))
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    path = os.path.join(tempfile.mkdtemp(), "rows.csv")
+    make_csv(path, rows)
+    for name, check_similar in [("default (exact only)", None), ("check_similar=True", True)]:
+        start = time.perf_counter()
+        result = extract_json_text(path, check_similar=check_similar)
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {elapsed:.2f} s, {len(result['content']['text'])} blocks from {rows:,} rows")
+
+if __name__ == "__main__":
+    main()
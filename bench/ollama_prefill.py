@@ -0,0 +1,70 @@
+"""Prompt tokens Ollama evaluates per turn, with and without OLLAMA_SESSION.
+
+Runs a short conversation over a fixed context against the stand-in server in
+mocks/fake_ollama.py and prints the prefill reported for each turn. With the
+session layout only the new turn should be evaluated. window sets
+OLLAMA_CONTEXT_TOKENS, the token budget the prompt is trimmed to.
+
+    python bench/ollama_prefill.py [turns] [window]
+"""
+import contextlib
+import io
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "mocks"))
+
+def run(turns, session, port):
+    os.environ['OLLAMA_HOST'] = f"http://127.0.0.1:{port}"
+    os.environ['OLLAMA_SESSION'] = "1" if session else ""
+    work = tempfile.mkdtemp()
+    os.chdir(work)
+    context_dir = os.path.join(work, "context")
+    os.makedirs(context_dir)
+    random.seed(0)
+    with open(os.path.join(context_dir, "notes.txt"), "w") as f:
+        f.write(" ".join(random.choice(["alpha", "beta", "gamma", "delta", "epsilon"]) for _ in range(3000)))
+
+    import clients
+    import model_interact
+    clients.reset_clients()
+    with contextlib.redirect_stdout(io.StringIO()):
+        playground = model_interact.AIPlayground(context_dir=context_dir, history_file="history.json")
+    prefill = []
+    for i in range(turns):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            playground.process_prompt(f"question number {i}?", 'ollama', model_name='llama3.2:latest',
+                                      image_skip=True, use_cache=False)
+        match = re.search(r"Ollama prefill: (\d+)", output.getvalue())
+        prefill.append(int(match.group(1)) if match else None)
+    return prefill
+
+def main():
+    turns = int(sys.argv[1]) if len(sys.argv) > 1 else 6
+    if len(sys.argv) > 3:
+        # Child run: one layout per process so the client and settings start fresh
+        print(run(turns, sys.argv[2] == "session", int(sys.argv[3])))
+        return
+    if len(sys.argv) > 2:
+        os.environ['OLLAMA_CONTEXT_TOKENS'] = sys.argv[2]
+    from fake_ollama import serve
+    server = serve()
+    port = server.server_address[1]
+    for mode in ("default", "session"):
+        result = subprocess.run([sys.executable, __file__, str(turns), mode, str(port)],
+                                capture_output=True, text=True)
+        if result.returncode:
+            print(result.stderr)
+            continue
+        print(f"{mode}: prompt tokens evaluated per turn {result.stdout.strip()}")
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import socket
+import httpx
+import httpcore
+from clients import current_scope
+
+class _CancellableStream(httpcore.NetworkStream):
+    # Delegates to the real stream; while a read or write blocks, the stream is
+    # attached to the caller's ClientScope so cancelling it can shut the socket down
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def _blocking(self, fn, *args):
+        scope = current_scope()
+        if scope is None:
+            return fn(*args)
+        # Pooled connections outlive the request, so they are only attached while in use
+        scope.attach(self)
+        try:
+            return fn(*args)
+        finally:
+            scope.detach(self)
+
+    def read(self, max_bytes, timeout=None):
+        return self._blocking(self._stream.read, max_bytes, timeout)
+
+    def write(self, buffer, timeout=None):
+        self._blocking(self._stream.write, buffer, timeout)
+
+    def close(self):
+        self._stream.close()
+
+    def start_tls(self, ssl_context, server_hostname=None, timeout=None):
+        return _CancellableStream(self._blocking(self._stream.start_tls, ssl_context, server_hostname, timeout))
+
+    def get_extra_info(self, info):
+        return self._stream.get_extra_info(info)
+
+    def shutdown(self):
+        sock = self._stream.get_extra_info("socket")
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+class _CancellableBackend(httpcore.SyncBackend):
+    def connect_tcp(self, *args, **kwargs):
+        scope = current_scope()
+        if scope is not None:
+            scope.check()
+        return _CancellableStream(super().connect_tcp(*args, **kwargs))
+
+    def connect_unix_socket(self, *args, **kwargs):
+        scope = current_scope()
+        if scope is not None:
+            scope.check()
+        return _CancellableStream(super().connect_unix_socket(*args, **kwargs))
+
+class CancellableTransport(httpx.HTTPTransport):
+    """httpx transport whose calls can be aborted by cancelling the caller's ClientScope.
+
+    Closing an httpx client does not wake a thread blocked reading a response,
+    so ClientScope.cancel() shuts the sockets in use down instead. The
+    connection pool itself is long-lived and shared by every request.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # httpx has no option for the network backend; the pool reads it when connecting
+        self._pool._network_backend = _CancellableBackend()
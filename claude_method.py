@@ -1,57 +1,40 @@
 from dotenv import load_dotenv
-import anthropic
-import os
-import base64
-from PIL import Image
-from io import BytesIO
-from prep_file import combine_json, context_directory, extract_text_content, extract_image_directory_from_json, image_to_base64
-from pathlib import Path
+from prep_file import ExtractedContent
+from image_prep import prepare_image_base64
+from clients import get_client
+from response_cache import StreamError
+from prompt_cache import caching_enabled, context_hash, report_anthropic_usage
+from prompt_layout import PromptLayout
 
 load_dotenv()
 
-def claude_api(prompt, file_path=None, context_dir=None, model_name='claude-3-sonnet-20240220', max_tokens=1000, chat_history=None, chat_history_images=None, image_skip=False):
+# Provider defaults are used; listed for the response cache key
+SAMPLING = {}
+
+def claude_api(prompt, file_path=None, context_dir=None, model_name='claude-3-sonnet-20240220', max_tokens=1000, chat_history=None, chat_history_images=None, image_skip=False, extracted=None, stream=False):
     print(f"Claude API called with prompt: {prompt[:100]}...")
     print(f"File path: {file_path}")
     print(f"Context directory: {context_dir}")
     print(f"Image skip: {image_skip}")
     
-    client = anthropic.Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
-
-    # Process context directory
-    context_content = ""
-    context_img_paths = []
-    if context_dir:
-        print("Processing context_dir")
-        context_json_file = context_directory(context_dir, image_skip=image_skip, use_cache=True)
-        print(f"Context JSON file keys: {list(context_json_file.keys())}")
-        context_content = extract_text_content(context_json_file)
-        print(f"Extracted context content length: {len(context_content)}")
-        
-        # Extract images from context if not skipping
-        if not image_skip:
-            for file_json in context_json_file.values():
-                img_dir = extract_image_directory_from_json(file_json)
-                if img_dir:
-                    context_img_paths.extend(list(img_dir.glob("*.png")))
+    client = get_client('anthropic')
 
-    # Process file path
-    file_content = ""
-    img_paths = []
-    if file_path:
-        json_file = combine_json(file_path, image_skip=image_skip)
-        file_content = extract_text_content(json_file)
-        if not image_skip:
-            img_dir = extract_image_directory_from_json(json_file)
-            if img_dir:
-                img_paths = list(img_dir.glob("*.png"))
+    # Reuse the request's extraction, only extracting here when called standalone
+    if extracted is None:
+        extracted = ExtractedContent.build(file_path, context_dir, image_skip=image_skip)
+    context_content = extracted.context_text
+    file_content = extracted.file_text
+    print(f"Extracted context content length: {len(context_content)}")
     
-    # Combine content
-    message_parts = []
-    if context_content:
-        message_parts.append(f"Context: {context_content}")
-    if file_content:
-        message_parts.append(f"File: {file_content}")
-    message_content = "\n".join(message_parts).strip()
+    layout = PromptLayout(prompt, context_content, file_content, chat_history)
+
+    # With prompt caching on, the context goes in a cached system block instead of the message
+    use_prompt_cache = caching_enabled('anthropic') and bool(context_content)
+    cache_key = context_hash(context_content) if use_prompt_cache else None
+    system = [{"type": "text", "text": layout.system}]
+    if use_prompt_cache:
+        system.append({"type": "text", "text": f"Context: {context_content}", "cache_control": {"type": "ephemeral"}})
+    message_content = layout.text(skip=('context',) if use_prompt_cache else ())
     
     if message_content:
         print(f"Final message_content length: {len(message_content)}")
@@ -62,7 +45,7 @@ def claude_api(prompt, file_path=None, context_dir=None, model_name='claude-3-so
     # Combine all image paths if not skipping
     all_img_paths = []
     if not image_skip:
-        all_img_paths = img_paths + context_img_paths
+        all_img_paths = extracted.image_paths()
     
     # Process chat history images
     if not image_skip and chat_history_images:
@@ -70,20 +53,6 @@ def claude_api(prompt, file_path=None, context_dir=None, model_name='claude-3-so
     
     print(f"Total number of images to process: {len(all_img_paths)}")
     
-    # Prepare messages for Claude
-    messages = [{"role": "user", "content": []}]
-    
-    # Add chat history to the messages
-    if chat_history:
-        messages[0]["content"].insert(0, {"type": "text", "text": f"Previous conversation: {chat_history}"})
-    
-    # Add text content
-    if message_content:
-        messages[0]["content"].append({"type": "text", "text": message_content})
-    
-    # Add prompt
-    messages[0]["content"].append({"type": "text", "text": prompt})
-    
     # Add images if not skipping
     image_summaries = ""
     if not image_skip and all_img_paths:
@@ -91,18 +60,14 @@ def claude_api(prompt, file_path=None, context_dir=None, model_name='claude-3-so
         image_summary_messages = [{"role": "user", "content": [{"type": "text", "text": "Describe each image in 50 words or less:"}]}]
         for img_path in all_img_paths:
             try:
-                if isinstance(img_path, (str, Path)):
-                    img_data = image_to_base64(str(img_path))
-                else:
-                    buffered = BytesIO()
-                    img_path.save(buffered, format="PNG")
-                    img_data = base64.b64encode(buffered.getvalue()).decode('utf-8')
+                # Downscaled and recompressed before upload
+                img_data, media_type = prepare_image_base64(img_path, 'anthropic')
                 
                 image_summary_messages[0]["content"].append({
                     "type": "image",
                     "source": {
                         "type": "base64",
-                        "media_type": "image/png",
+                        "media_type": media_type,
                         "data": img_data
                     }
                 })
@@ -120,14 +85,35 @@ def claude_api(prompt, file_path=None, context_dir=None, model_name='claude-3-so
             print(f"Error generating image summaries: {str(e)}")
 
     # Generate content summary without images
-    content_summary_messages = [{"role": "user", "content": [{"type": "text", "text": f"{message_content}\n\n{prompt}"}]}]
+    content_summary_messages = [{"role": "user", "content": [{"type": "text", "text": message_content}]}]
+
+    if stream:
+        def stream_content():
+            try:
+                with client.messages.stream(
+                    model=model_name,
+                    max_tokens=max_tokens,
+                    messages=content_summary_messages,
+                    system=system
+                ) as response:
+                    yield from response.text_stream
+                    if use_prompt_cache:
+                        report_anthropic_usage(model_name, cache_key, response.get_final_message().usage)
+            except Exception as e:
+                error_msg = f"Error in Claude API call: {str(e)}"
+                print(error_msg)
+                yield StreamError(error_msg)
+        return image_summaries, stream_content()
     
     try:
         content_summary_response = client.messages.create(
             model=model_name,
             max_tokens=max_tokens,
-            messages=content_summary_messages
+            messages=content_summary_messages,
+            system=system
         )
+        if use_prompt_cache:
+            report_anthropic_usage(model_name, cache_key, content_summary_response.usage)
         content_summary = content_summary_response.content[0].text
         return image_summaries, content_summary
     except Exception as e:
@@ -0,0 +1,129 @@
+import os
+import json
+import threading
+import contextvars
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# SDK clients are created once per session and shared by every call, so
+# batch workers reuse the same keep-alive connection pools. The SDK clients
+# (httpx underneath) are safe to share between threads.
+_clients = {}
+_gemini_models = {}
+_lock = threading.Lock()
+
+class RequestCancelled(Exception):
+    pass
+
+def _http_client():
+    # Every call goes through a CancellableTransport so a ClientScope can abort it
+    import httpx
+    from cancellable_http import CancellableTransport
+    return httpx.Client(transport=CancellableTransport())
+
+def _create_client(provider):
+    if provider == 'anthropic':
+        import anthropic
+        return anthropic.Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"), http_client=_http_client())
+    elif provider == 'openai':
+        from openai import OpenAI
+        return OpenAI(api_key=os.environ.get("OPENAI_API_KEY"), http_client=_http_client())
+    elif provider == 'mistral':
+        from mistralai.client import MistralClient
+        return MistralClient(api_key=os.environ.get("MISTRAL_API_KEY"))
+    elif provider == 'ollama':
+        import ollama
+        from cancellable_http import CancellableTransport
+        return ollama.Client(host=os.environ.get("OLLAMA_HOST"), transport=CancellableTransport())
+    elif provider == 'google':
+        import google.generativeai as genai
+        genai.configure(api_key=os.environ.get("GOOGLE_API_KEY"))
+        return genai
+    raise ValueError(f"Invalid provider: {provider}")
+
+# The ClientScope of the request running in this context, if any
+_scope = contextvars.ContextVar("client_scope", default=None)
+
+class ClientScope:
+    """Cancellation for the calls one request makes through the shared clients.
+
+    Inside `with scope:` a read or write on a connection of the Anthropic,
+    OpenAI or Ollama client registers that connection with the scope while it
+    blocks, and cancel() shuts those connections down. Gemini's SDK and the
+    Mistral client take no transport; their calls are not aborted, only
+    refused once cancelled. Worker threads see the scope when started with
+    in_current_scope().
+    """
+
+    def __init__(self):
+        self._streams = set()
+        self._lock = threading.Lock()
+        self.cancelled = False
+
+    def __enter__(self):
+        self._token = _scope.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _scope.reset(self._token)
+
+    def check(self):
+        if self.cancelled:
+            raise RequestCancelled("Request cancelled")
+
+    def attach(self, stream):
+        with self._lock:
+            self.check()
+            self._streams.add(stream)
+
+    def detach(self, stream):
+        with self._lock:
+            self._streams.discard(stream)
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            streams = list(self._streams)
+        for stream in streams:
+            stream.shutdown()
+
+def current_scope():
+    return _scope.get()
+
+def in_current_scope(fn):
+    # Pool threads do not inherit context variables, so each call runs in a copy of the caller's context
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(fn, *args, **kwargs)
+
+def _close(client):
+    if hasattr(client, 'close'):
+        try:
+            client.close()
+        except Exception:
+            pass
+
+def get_client(provider):
+    scope = _scope.get()
+    if scope is not None:
+        scope.check()
+    with _lock:
+        if provider not in _clients:
+            _clients[provider] = _create_client(provider)
+        return _clients[provider]
+
+def get_gemini_model(model_name, generation_config):
+    genai = get_client('google')
+    key = (model_name, json.dumps(generation_config, sort_keys=True))
+    with _lock:
+        if key not in _gemini_models:
+            _gemini_models[key] = genai.GenerativeModel(model_name, generation_config=generation_config)
+        return _gemini_models[key]
+
+def reset_clients():
+    # Drop all clients, e.g. after API keys change; the next call builds new ones
+    with _lock:
+        for client in _clients.values():
+            _close(client)
+        _clients.clear()
+        _gemini_models.clear()
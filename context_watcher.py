@@ -0,0 +1,93 @@
+import os
+import threading
+
+# Changes are handed on once the directory has been quiet this long, so a
+# burst of writes (a copy, a checkout) causes a single refresh
+WATCH_DEBOUNCE_SECONDS = 2.0
+
+class ContextWatcher:
+    """Watches a context directory and records which directories changed.
+
+    Uses the optional watchdog package (inotify on Linux). A ContextCache
+    with a running watcher only re-lists the directories reported here.
+    on_change is called from a background thread once changes settle, to
+    refresh the cache before the next prompt needs it.
+    """
+
+    def __init__(self, context_dir, on_change=None, debounce=WATCH_DEBOUNCE_SECONDS):
+        self.context_dir = context_dir
+        self.on_change = on_change
+        self.debounce = debounce
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._timer = None
+        self._observer = None
+
+    def start(self):
+        try:
+            from watchdog.observers import Observer
+            from watchdog.events import FileSystemEventHandler
+        except ImportError:
+            print("watchdog is not installed; context changes are found by scanning")
+            return False
+
+        watcher = self
+
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                watcher._record(event)
+
+        try:
+            observer = Observer()
+            observer.schedule(Handler(), self.context_dir, recursive=True)
+            observer.daemon = True
+            observer.start()
+        except Exception as e:
+            # E.g. the inotify watch limit was reached
+            print(f"Could not watch {self.context_dir}: {str(e)}")
+            return False
+        self._observer = observer
+        return True
+
+    @property
+    def running(self):
+        return self._observer is not None and self._observer.is_alive()
+
+    def _record(self, event):
+        if event.event_type in ('opened', 'closed', 'closed_no_write'):
+            return
+        with self._lock:
+            for path in (event.src_path, getattr(event, 'dest_path', None)):
+                if not path:
+                    continue
+                path = os.path.normpath(os.fsdecode(path))
+                self._dirty.add(os.path.dirname(path))
+                if event.is_directory:
+                    self._dirty.add(path)
+            if self.on_change:
+                if self._timer:
+                    self._timer.cancel()
+                self._timer = threading.Timer(self.debounce, self._notify)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _notify(self):
+        try:
+            self.on_change()
+        except Exception as e:
+            print(f"Error refreshing context after a change: {str(e)}")
+
+    def take_changes(self):
+        # Normalized paths of the directories changed since the last call
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        return dirty
+
+    def stop(self):
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+        if self._observer:
+            self._observer.stop()
+            self._observer.join(timeout=5)
+            self._observer = None
@@ -1,13 +1,68 @@
 from dotenv import load_dotenv
-import google.generativeai as genai
-from pathlib import Path
-import os
-import PIL.Image
-from prep_file import combine_json, context_directory, extract_text_content, extract_image_directory_from_json
+from datetime import timedelta
+from prep_file import ExtractedContent
+from clients import get_client, get_gemini_model
+from image_summary import describe_images, image_label, IMAGE_PROMPT
+from image_prep import prepare_image
+from prompt_cache import caching_enabled, context_hash, prompt_caches, GEMINI_CACHE_TTL
+from token_budget import estimate_tokens
+from prompt_layout import PromptLayout, SYSTEM_PROMPT
 
 load_dotenv()
 
-def gemini_api(prompt, file_path=None, context_dir=None, model_name='flash', max_tokens=500, chat_history=None, chat_history_images=None, image_skip=True):
+# Sampling settings sent with every call (also part of the response cache key)
+SAMPLING = {"temperature": 0.3, "top_p": 0.95, "top_k": 60}
+
+# Cached contents need a pinned model version and at least 32k tokens of content
+GEMINI_CACHE_VERSIONS = {
+    'gemini-1.5-flash': 'gemini-1.5-flash-002',
+    'gemini-1.5-pro': 'gemini-1.5-pro-002'
+}
+GEMINI_CACHE_MIN_TOKENS = 32768
+
+def cached_context_model(model_name, context_content, generation_config):
+    """Return (model, version, hit) for a model whose cached content holds the context.
+
+    The model is None when the context should be sent inline instead: caching
+    is off, the context is too small to cache, or the cache could not be made.
+    """
+    version = GEMINI_CACHE_VERSIONS.get(model_name, model_name)
+    if not caching_enabled('google') or estimate_tokens(context_content) < GEMINI_CACHE_MIN_TOKENS:
+        return None, version, False
+    key = context_hash(context_content)
+    handle = prompt_caches.get('google', version, key)
+    hit = handle is not None
+    try:
+        genai = get_client('google')
+        if not hit:
+            from google.generativeai import caching
+            handle = caching.CachedContent.create(
+                model=f"models/{version}",
+                contents=[f"Context: {context_content}"],
+                system_instruction=SYSTEM_PROMPT,
+                ttl=timedelta(seconds=GEMINI_CACHE_TTL)
+            )
+            prompt_caches.put('google', version, key, handle, GEMINI_CACHE_TTL)
+        return genai.GenerativeModel.from_cached_content(cached_content=handle, generation_config=generation_config), version, hit
+    except Exception as e:
+        print(f"Gemini context cache unavailable, sending the context inline: {str(e)}")
+        return None, version, False
+
+def stream_text(response):
+    for chunk in response:
+        try:
+            text = chunk.text
+        except ValueError:  # Chunks without text parts, e.g. a finish or safety marker
+            continue
+        if text:
+            yield text
+
+def report_cache_usage(version, hit, response, stream):
+    # Token counts are only known up front for non-streamed responses
+    cached_tokens = 0 if stream else getattr(response.usage_metadata, 'cached_content_token_count', 0) or 0
+    prompt_caches.report('google', version, hit, cached_tokens)
+
+def gemini_api(prompt, file_path=None, context_dir=None, model_name='flash', max_tokens=500, chat_history=None, chat_history_images=None, image_skip=True, extracted=None, stream=False):
     print(f"Gemini API called with prompt: {prompt[:100]}...")
     print(f"File path: {file_path}")
     print(f"Context directory: {context_dir}")
@@ -20,39 +75,23 @@ def gemini_api(prompt, file_path=None, context_dir=None, model_name='flash', max
     }
     full_model_name = model_name_mapping.get(model_name, 'gemini-1.5-flash')
     
-    genai.configure(api_key=os.environ.get("GOOGLE_API_KEY"))
-    generation_config = {
-        "temperature": 0.3,
-        "top_p": 0.95,
-        "top_k": 60,
-        "max_output_tokens": max_tokens
-    }
-    model = genai.GenerativeModel(full_model_name, generation_config=generation_config)
+    generation_config = {**SAMPLING, "max_output_tokens": max_tokens}
+    model = get_gemini_model(full_model_name, generation_config)
 
-    # Process context directory
-    context_content = ""
-    if context_dir:
-        print("Processing context_dir")
-        context_json_file = context_directory(context_dir, image_skip=image_skip, use_cache=True)
-        print(f"Context JSON file keys: {list(context_json_file.keys())}")
-        context_content = extract_text_content(context_json_file)
-        print(f"Extracted context content length: {len(context_content)}")
+    # Reuse the request's extraction, only extracting here when called standalone
+    if extracted is None:
+        extracted = ExtractedContent.build(file_path, context_dir, image_skip=image_skip)
+    context_content = extracted.context_text
+    file_content = extracted.file_text
+    print(f"Extracted context content length: {len(context_content)}")
 
-    # Process file path
-    file_content = ""
-    if file_path:
-        json_file = combine_json(file_path, image_skip=image_skip)
-        file_content = extract_text_content(json_file)
-    
-    # Combine content
-    message_parts = []
-    if context_content:
-        message_parts.append(f"Context: {context_content}")
-    if file_content:
-        message_parts.append(f"File: {file_content}")
-    message_content = "\n".join(message_parts).strip()
-    if chat_history:
-        message_parts.append(f"Chat History: {chat_history}")
+    # With prompt caching on, a large context is read from a cached content instead of being resent
+    cached_model, cache_version, cache_hit = cached_context_model(full_model_name, context_content, generation_config)
+    answer_model = cached_model or model
+
+    # The cached content already holds the system prompt and the context
+    layout = PromptLayout(prompt, context_content, file_content, chat_history)
+    message_content = layout.text(skip=('context',)) if cached_model else layout.text(system=True)
     
     if message_content:
         print(f"Final message_content length: {len(message_content)}")
@@ -63,21 +102,14 @@ def gemini_api(prompt, file_path=None, context_dir=None, model_name='flash', max
     # Skip image processing if image_skip is True
     if image_skip:
         print("Image processing skipped.")
-        response = model.generate_content([prompt, message_content] if message_content else [prompt])
-        return "", response.text
+        response = answer_model.generate_content([message_content], stream=stream)
+        if cached_model:
+            report_cache_usage(cache_version, cache_hit, response, stream)
+        return "", stream_text(response) if stream else response.text
     
     # Process images only if image_skip is False
     print("Processing images...")
-    all_img_paths = []
-    if file_path:
-        img_dir = extract_image_directory_from_json(json_file)
-        if img_dir:
-            all_img_paths.extend(list(img_dir.glob("*.png")))
-    if context_dir:
-        for file_json in context_json_file.values():
-            img_dir = extract_image_directory_from_json(file_json)
-            if img_dir:
-                all_img_paths.extend(list(img_dir.glob("*.png")))
+    all_img_paths = extracted.image_paths()
     if chat_history_images:
         all_img_paths.extend(chat_history_images)
     
@@ -85,16 +117,29 @@ def gemini_api(prompt, file_path=None, context_dir=None, model_name='flash', max
     
     image_summaries = []
     if all_img_paths:
-        for image in all_img_paths:
-            print(f"Processing image: {getattr(image, 'name', 'chat history image')}")
-            if isinstance(image, (str, Path)):  # It's a file path or Path object
-                img = PIL.Image.open(str(image))
-            else:  # It's already a PIL.Image object
-                img = image
-            response = model.generate_content(["Describe this image in 50 words or less:", img])
-            image_summaries.append(f"Image {getattr(image, 'name', 'chat history image')}: {response.text}")
+        def load(image):
+            # File paths and chat history images are downscaled and recompressed before upload
+            data, mime_type = prepare_image(image, 'google')
+            return {'mime_type': mime_type, 'data': data}
+
+        def describe(image):
+            return model.generate_content([IMAGE_PROMPT, load(image)]).text
+
+        def describe_batch(images, batch_prompt):
+            return model.generate_content([batch_prompt, *[load(image) for image in images]]).text
+
+        # Several images go in each request and each image is only described once per model
+        results = describe_images(all_img_paths, 'google', full_model_name, describe, describe_batch)
+        for image, (summary, error) in zip(all_img_paths, results):
+            if error:
+                print(f"Error processing image {image_label(image)}: {str(error)}")
+                image_summaries.append(f"Error processing image {image_label(image)}: {str(error)}")
+            else:
+                image_summaries.append(f"Image {image_label(image)}: {summary}")
 
     # Generate content summary
-    content_summary = model.generate_content([prompt, message_content] if message_content else [prompt])
+    content_summary = answer_model.generate_content([message_content], stream=stream)
+    if cached_model:
+        report_cache_usage(cache_version, cache_hit, content_summary, stream)
     
-    return "\n\n".join(image_summaries) if image_summaries else "", content_summary.text
+    return "\n\n".join(image_summaries) if image_summaries else "", stream_text(content_summary) if stream else content_summary.text
@@ -0,0 +1,135 @@
+import os
+import json
+import hashlib
+import threading
+
+# Messages kept verbatim in every prompt, and how many older ones are folded
+# into the summary at a time. Override with HISTORY_TURNS / HISTORY_FOLD_TURNS.
+HISTORY_TURNS = int(os.environ.get("HISTORY_TURNS", 6))
+HISTORY_FOLD_TURNS = int(os.environ.get("HISTORY_FOLD_TURNS", 4))
+SUMMARY_WORDS = 200
+
+SUMMARY_PROMPT = (
+    "Update the summary of a conversation with the new messages below. Keep names, facts, decisions "
+    "and open questions; drop small talk. Answer with the updated summary only, in {words} words or less.\n\n"
+    "Current summary:\n{summary}\n\nNew messages:\n{messages}"
+)
+
+def format_messages(messages):
+    return "\n".join(f"{msg['role']}: {msg['content']}" for msg in messages)
+
+def format_history(summary, messages):
+    parts = []
+    if summary:
+        parts.append(f"Summary of earlier conversation: {summary}")
+    if messages:
+        parts.append(format_messages(messages))
+    return "\n".join(parts)
+
+def history_messages(summary, messages):
+    # The same history as chat messages, for providers that take a message list
+    chat = [{"role": "user", "content": f"Summary of earlier conversation: {summary}"}] if summary else []
+    return chat + [{"role": msg["role"], "content": msg["content"]} for msg in messages]
+
+def trim_history_messages(summary, messages, history_text):
+    """history_messages(summary, messages) cut down to history_text.
+
+    history_text is format_history(summary, messages) with its start trimmed
+    off to fit a token budget: messages that fall outside it are dropped and
+    the first one it cuts into keeps only its visible end.
+    """
+    chat = history_messages(summary, messages)
+    if not history_text:
+        return []
+    end = len(format_history(summary, messages))
+    cut = end - len(history_text)
+    # Each chat message is one line of the formatted history, after a label
+    labels = [0] * (1 if summary else 0) + [len(msg['role']) + 2 for msg in messages]
+    kept = []
+    for msg, label in zip(reversed(chat), reversed(labels)):
+        start = end - label - len(msg['content'])
+        if start >= cut:
+            kept.append(msg)
+        else:
+            content = msg['content'][max(0, cut - start - label):]
+            if content:
+                kept.append({"role": msg["role"], "content": content})
+            break
+        end = start - 1  # The newline between lines
+    return kept[::-1]
+
+def messages_hash(messages):
+    # Text only; attached images would make this slow for no benefit
+    text = [[msg.get('role'), msg.get('content')] for msg in messages]
+    return hashlib.sha256(json.dumps(text).encode('utf-8')).hexdigest()
+
+class RollingSummary:
+    """Summary of the chat history that has aged out of the verbatim window.
+
+    Prompts carry this summary plus the last keep_turns messages, so their size
+    stays flat over a long session. Aged-out messages are folded in
+    fold_turns at a time: each update summarizes only the previous summary and
+    the new messages. The summary is saved next to the history file and reset
+    if the messages it covers change.
+    """
+
+    def __init__(self, path, keep_turns=HISTORY_TURNS, fold_turns=HISTORY_FOLD_TURNS):
+        self.path = path
+        self.keep_turns = keep_turns
+        self.fold_turns = max(1, fold_turns)
+        self.lock = threading.Lock()
+        self.summary = ""
+        self.covered = 0  # Number of leading messages folded into the summary
+        self.covered_hash = messages_hash([])
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        self.summary = state.get("summary", "")
+        self.covered = state.get("covered", 0)
+        self.covered_hash = state.get("covered_hash", messages_hash([]))
+
+    def save(self):
+        try:
+            with open(self.path, 'w', encoding='utf-8') as f:
+                json.dump({"summary": self.summary, "covered": self.covered, "covered_hash": self.covered_hash}, f, ensure_ascii=False, indent=4)
+        except IOError as e:
+            print(f"Error saving history summary: {e}")
+
+    def reset(self):
+        with self.lock:
+            self.summary, self.covered, self.covered_hash = "", 0, messages_hash([])
+            self.save()
+
+    def update(self, messages, summarize):
+        """Fold aged-out messages into the summary; returns (summary, messages to keep verbatim).
+
+        summarize(prompt) returns the new summary text. If it fails, the
+        messages stay verbatim and are folded on a later call.
+        """
+        with self.lock:
+            if self.covered > len(messages) or messages_hash(messages[:self.covered]) != self.covered_hash:
+                # The history was cleared or edited since the summary was made
+                self.summary, self.covered, self.covered_hash = "", 0, messages_hash([])
+            cutoff = len(messages) - self.keep_turns
+            if cutoff - self.covered >= self.fold_turns:
+                prompt = SUMMARY_PROMPT.format(
+                    words=SUMMARY_WORDS,
+                    summary=self.summary or "(none yet)",
+                    messages=format_messages(messages[self.covered:cutoff])
+                )
+                try:
+                    summary = summarize(prompt)
+                except Exception as e:
+                    summary = None
+                    print(f"Error summarizing history: {str(e)}")
+                if summary and not summary.startswith("Error"):
+                    self.summary = summary.strip()
+                    self.covered = cutoff
+                    self.covered_hash = messages_hash(messages[:cutoff])
+                    self.save()
+            return self.summary, messages[self.covered:]
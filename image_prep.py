@@ -0,0 +1,109 @@
+import os
+import io
+import json
+import base64
+import hashlib
+import tempfile
+import threading
+from PIL import Image
+from image_summary import image_hash
+from response_cache import directory_size, evict_least_recent
+
+# Longest side and encoding used for the images sent to each provider. The
+# providers downscale larger images themselves, so sending them only costs
+# upload bytes and vision tokens. IMAGE_MAX_DIM / IMAGE_QUALITY override these.
+PROVIDER_IMAGE_SETTINGS = {
+    'anthropic': {'max_dim': 1568, 'format': 'WEBP', 'quality': 80},
+    'openai': {'max_dim': 2048, 'format': 'WEBP', 'quality': 80},
+    'google': {'max_dim': 3072, 'format': 'WEBP', 'quality': 80},
+    'ollama': {'max_dim': 1344, 'format': 'JPEG', 'quality': 85},  # llama.cpp cannot decode WebP
+}
+DEFAULT_IMAGE_SETTINGS = {'max_dim': 2048, 'format': 'JPEG', 'quality': 85}
+MIME_TYPES = {'JPEG': 'image/jpeg', 'WEBP': 'image/webp', 'PNG': 'image/png', 'GIF': 'image/gif'}
+
+PREPARED_IMAGE_DIR = "prepared_images"
+PREPARED_IMAGE_MAX_BYTES = 200 * 1024 * 1024
+
+_lock = threading.Lock()
+_total = None
+
+def image_settings(provider):
+    settings = dict(PROVIDER_IMAGE_SETTINGS.get(provider, DEFAULT_IMAGE_SETTINGS))
+    settings['max_dim'] = int(os.environ.get("IMAGE_MAX_DIM", settings['max_dim']))
+    settings['quality'] = int(os.environ.get("IMAGE_QUALITY", settings['quality']))
+    return settings
+
+def _local_path(image):
+    image = str(image)
+    return image[7:] if image.startswith('file://') else image
+
+def _encode(img, settings):
+    if max(img.size) > settings['max_dim']:
+        img = img.copy()
+        img.thumbnail((settings['max_dim'], settings['max_dim']), Image.LANCZOS)
+    if settings['format'] == 'JPEG' and img.mode != 'RGB':
+        # JPEG has no alpha channel, so transparent areas become white
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        rgba = img.convert('RGBA')
+        background.paste(rgba, mask=rgba.split()[-1])
+        img = background
+    elif img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA' if 'A' in img.getbands() or 'transparency' in img.info else 'RGB')
+    buffered = io.BytesIO()
+    img.save(buffered, format=settings['format'], quality=settings['quality'])
+    return buffered.getvalue()
+
+def _store(path, data):
+    global _total
+    os.makedirs(PREPARED_IMAGE_DIR, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=PREPARED_IMAGE_DIR, suffix=".tmp")
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+    with _lock:
+        if _total is None:
+            _total = directory_size(PREPARED_IMAGE_DIR, ".img")
+        else:
+            _total += len(data)
+        if _total > PREPARED_IMAGE_MAX_BYTES:
+            _total = evict_least_recent(PREPARED_IMAGE_DIR, PREPARED_IMAGE_MAX_BYTES, ".img")
+
+def prepare_image(image, provider):
+    """Return (bytes, mime_type) of the image as it should be sent to the provider.
+
+    image is a file path, a file:// URL or a PIL image. The result is downscaled
+    to the provider's max_dim and re-encoded, and is cached on disk by image
+    content and settings. Small images whose re-encoding would be larger are
+    kept as they are.
+    """
+    settings = image_settings(provider)
+    key = hashlib.sha256(json.dumps([image_hash(image), settings], sort_keys=True).encode()).hexdigest()
+    path = os.path.join(PREPARED_IMAGE_DIR, f"{key}.img")
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        os.utime(path)
+        with Image.open(io.BytesIO(data)) as img:  # Only reads the header
+            return data, MIME_TYPES.get(img.format, 'image/png')
+    except (FileNotFoundError, OSError):
+        pass
+    mime_type = MIME_TYPES.get(settings['format'], 'image/png')
+
+    if isinstance(image, Image.Image):
+        data = _encode(image, settings)
+    else:
+        with open(_local_path(image), 'rb') as f:
+            original = f.read()
+        with Image.open(io.BytesIO(original)) as img:
+            original_format = img.format
+            small = max(img.size) <= settings['max_dim']
+            data = _encode(img, settings)
+        if small and len(original) <= len(data) and original_format in MIME_TYPES:
+            # Nothing to gain, so the original bytes (and format) are kept
+            data, mime_type = original, MIME_TYPES[original_format]
+    _store(path, data)
+    return data, mime_type
+
+def prepare_image_base64(image, provider):
+    data, mime_type = prepare_image(image, provider)
+    return base64.b64encode(data).decode('utf-8'), mime_type
@@ -0,0 +1,145 @@
+import os
+import re
+import hashlib
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from response_cache import ResponseCache
+from clients import in_current_scope
+
+IMAGE_PROMPT = "Describe this image in 50 words or less:"
+BATCH_IMAGE_PROMPT = (
+    "Describe each of the {count} images in 50 words or less. Answer in order, starting each "
+    "description on a new line with 'Image <number>:' where <number> runs from 1 to {count}."
+)
+
+# Images packed into one vision request, per provider (IMAGE_BATCH_SIZE overrides the count)
+PROVIDER_IMAGE_LIMITS = {
+    'google': {'max_images': 16, 'max_bytes': 18 * 1024 * 1024},
+    'openai': {'max_images': 10, 'max_bytes': 18 * 1024 * 1024},
+    'ollama': {'max_images': 4, 'max_bytes': 32 * 1024 * 1024},
+}
+IMAGE_CONCURRENCY = int(os.environ.get("IMAGE_CONCURRENCY", 4))
+
+# Descriptions only depend on the image, the model and the prompt, so they
+# are kept much longer than full responses
+image_summary_cache = ResponseCache("image_summary_cache", ttl=90 * 24 * 3600, max_bytes=50 * 1024 * 1024)
+
+def image_hash(image):
+    if isinstance(image, Image.Image):
+        return hashlib.sha256(image.tobytes()).hexdigest()
+    image = str(image)
+    if image.startswith(('http://', 'https://')):
+        return hashlib.sha256(image.encode()).hexdigest()
+    if image.startswith('file://'):
+        image = image[7:]
+    with open(image, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def image_label(image):
+    if isinstance(image, Image.Image):
+        return 'chat history image'
+    return Path(str(image)).name
+
+def image_size(image):
+    if isinstance(image, Image.Image):
+        return image.width * image.height * 4
+    image = str(image)
+    if image.startswith(('http://', 'https://')):
+        return 0
+    if image.startswith('file://'):
+        image = image[7:]
+    try:
+        return os.path.getsize(image)
+    except OSError:
+        return 0
+
+def split_batch_answer(text, count):
+    # Split "Image 1: ... Image 2: ..." back into one description per image
+    parts = re.split(r'(?im)^[\s*#>-]*image\s+(\d+)\s*\**\s*[:.)-]\s*\**\s*', text or '')
+    descriptions = {}
+    for number, description in zip(parts[1::2], parts[2::2]):
+        descriptions.setdefault(int(number), description.strip())
+    if sorted(descriptions) != list(range(1, count + 1)) or not all(descriptions.values()):
+        return None
+    return [descriptions[i] for i in range(1, count + 1)]
+
+def make_batches(indexes, images, provider):
+    limits = PROVIDER_IMAGE_LIMITS.get(provider, {'max_images': 1, 'max_bytes': 0})
+    max_images = int(os.environ.get("IMAGE_BATCH_SIZE", limits['max_images']))
+    batches, batch, batch_bytes = [], [], 0
+    for i in indexes:
+        size = image_size(images[i])
+        if batch and (len(batch) >= max_images or (limits['max_bytes'] and batch_bytes + size > limits['max_bytes'])):
+            batches.append(batch)
+            batch, batch_bytes = [], 0
+        batch.append(i)
+        batch_bytes += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+def describe_images(images, provider, model, describe, describe_batch=None, prompt=IMAGE_PROMPT):
+    """Describe images, returning a (description, error) pair per image in order.
+
+    Cached descriptions are reused. The rest are packed into multi-image
+    requests through describe_batch(images, prompt) and the numbered answer is
+    split back per image. Without describe_batch, or when an answer cannot be
+    split, the images are described one by one with describe(image),
+    concurrently.
+    """
+    results = [(None, None)] * len(images)
+    keys = {}
+    pending = {}
+    for i, image in enumerate(images):
+        try:
+            keys[i] = image_summary_cache.make_key(image=image_hash(image), model=model, prompt=prompt)
+        except OSError:
+            keys[i] = None
+        cached = image_summary_cache.get(keys[i]) if keys[i] else None
+        if cached is not None:
+            results[i] = (cached, None)
+        else:
+            # Identical images in one request are described once
+            pending.setdefault(keys[i] or f"uncached-{i}", []).append(i)
+
+    def store(indexes, description):
+        key = keys[indexes[0]]
+        if description and key:
+            image_summary_cache.put(key, description)
+        for i in indexes:
+            results[i] = (description, None)
+
+    def run_single(indexes):
+        try:
+            store(indexes, describe(images[indexes[0]]))
+        except Exception as e:
+            for i in indexes:
+                results[i] = (None, e)
+
+    def run_batch(group):
+        batch_images = [images[pending_groups[g][0]] for g in group]
+        if describe_batch and len(group) > 1:
+            try:
+                answer = describe_batch(batch_images, BATCH_IMAGE_PROMPT.format(count=len(group)))
+                descriptions = split_batch_answer(answer, len(group))
+            except Exception as e:
+                print(f"Batched image description failed, describing one by one: {str(e)}")
+                descriptions = None
+            if descriptions:
+                for g, description in zip(group, descriptions):
+                    store(pending_groups[g], description)
+                return
+        with ThreadPoolExecutor(max_workers=IMAGE_CONCURRENCY) as executor:
+            list(executor.map(in_current_scope(run_single), [pending_groups[g] for g in group]))
+
+    pending_groups = list(pending.values())
+    representatives = [group[0] for group in pending_groups]
+    if describe_batch:
+        order = {i: g for g, i in enumerate(representatives)}
+        batches = [[order[i] for i in batch] for batch in make_batches(representatives, images, provider)]
+    else:
+        batches = [list(range(len(pending_groups)))]
+    with ThreadPoolExecutor(max_workers=IMAGE_CONCURRENCY) as executor:
+        list(executor.map(in_current_scope(run_batch), batches))
+    return results
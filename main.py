@@ -1,3 +1,7 @@
+import time
+STARTUP_TIME = time.perf_counter()  # Before any other import, for STARTUP_BENCHMARK
+
+import os
 import sys
 import io
 import base64
@@ -9,15 +13,92 @@ from PyQt6.QtWidgets import (QApplication, QMainWindow, QVBoxLayout, QHBoxLayout
                              QLabel, QScrollArea, QCheckBox, QProgressBar, QLineEdit,
                              QStyleFactory, QTextBrowser)
 from PyQt6.QtGui import (QPixmap, QTextCursor, QTextDocument, QIntValidator, QFontDatabase, QImage, QTextImageFormat)
-from PyQt6.QtCore import (QUrl, Qt)
+from PyQt6.QtCore import (QUrl, Qt, QThread, QObject, QEvent, QTimer, pyqtSignal)
 from PyQt6.QtNetwork import (QNetworkAccessManager, QNetworkRequest, QNetworkReply)
 from model_interact import AIPlayground
+from clients import ClientScope
+from token_budget import format_usage
 from prep_file import context_directory
+from read_image_url import start_garbage_collection
 from pygments import highlight
 from pygments.lexers import get_lexer_by_name
 from pygments.formatters import HtmlFormatter
 from pygments.util import ClassNotFound
 
+IMPORT_TIME = time.perf_counter()
+
+
+class FirstPaintTimer(QObject):
+    """With STARTUP_BENCHMARK=1, prints the time to the window's first paint and quits."""
+
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.Type.Paint:
+            obj.removeEventFilter(self)
+            # Report once the paint in progress has finished
+            QTimer.singleShot(0, self.report)
+        return False
+
+    def report(self):
+        now = time.perf_counter()
+        print(f"Imports: {IMPORT_TIME - STARTUP_TIME:.3f}s, first paint: {now - STARTUP_TIME:.3f}s")
+        QApplication.quit()
+
+
+class RequestWorker(QThread):
+    """Runs a prompt or batch off the GUI thread and reports back through signals."""
+
+    chunk = pyqtSignal(str)
+    batch_result = pyqtSignal(str, str)
+    response = pyqtSignal(str)
+    usage = pyqtSignal(str)
+    failed = pyqtSignal(str)
+
+    def __init__(self, playground, request, batch_dir=None):
+        super().__init__()
+        self.playground = playground
+        self.request = request
+        self.batch_dir = batch_dir
+        self.cancelled = False
+        # Cancelling the request's scope aborts its calls in flight on the shared clients
+        self.scope = ClientScope()
+
+    def cancel(self):
+        # Aborts the calls in flight; the flag is checked between chunks and batch
+        # files, and closing the generators then drops batch files not yet sent
+        self.cancelled = True
+        self.scope.cancel()
+
+    def run(self):
+        try:
+            with self.scope:
+                if self.batch_dir:
+                    results = self.playground.iter_batch(self.batch_dir, **self.request)
+                    for file_path, response in results:
+                        if self.cancelled:
+                            break
+                        self.batch_result.emit(file_path, response)
+                    results.close()
+                elif self.request["model_name"] == "dall-e-3":
+                    self.response.emit(self.playground.process_prompt(**self.request))
+                else:
+                    chunks = self.playground.stream_prompt(**self.request)
+                    parts = []
+                    for chunk in chunks:
+                        if self.cancelled:
+                            break
+                        parts.append(chunk)
+                        self.chunk.emit(chunk)
+                    chunks.close()
+                    if not self.cancelled:
+                        self.response.emit("".join(parts))
+            # Token counts are kept per thread, so these are this request's
+            if not self.batch_dir and self.playground.last_token_usage and not self.cancelled:
+                self.usage.emit(format_usage(self.playground.last_token_usage))
+        except Exception as e:
+            # A cancelled request fails with the aborted call's error; nobody is waiting for it
+            if not self.cancelled:
+                self.failed.emit(str(e))
+
 
 class AIPlaygroundGUI(QMainWindow):
     def __init__(self):
@@ -30,6 +111,9 @@ class AIPlaygroundGUI(QMainWindow):
         self.playground = AIPlayground(context_dir=None)
         self.file_path = None
         self.batch_dir = None
+        self.worker = None
+        self.running_workers = set()  # Cancelled workers stay referenced until their thread exits
+        self.stream_start = 0
         self.current_theme = "RedTheme"
         
         self.init_ui()
@@ -122,6 +206,16 @@ class AIPlaygroundGUI(QMainWindow):
         self.image_skip_checkbox.setChecked(True)  # Default to checked
         layout.addWidget(self.image_skip_checkbox)
 
+        # Retrieval checkbox: send only the context chunks relevant to the prompt
+        self.retrieval_checkbox = QCheckBox("Retrieve Relevant Context Only")
+        self.retrieval_checkbox.setChecked(self.playground.retrieval)
+        self.retrieval_checkbox.toggled.connect(self.toggle_retrieval)
+        layout.addWidget(self.retrieval_checkbox)
+
+        # Response cache checkbox: ask the model again instead of replaying a cached answer
+        self.skip_cache_checkbox = QCheckBox("Skip Response Cache")
+        layout.addWidget(self.skip_cache_checkbox)
+
         # Add file selection
         file_layout = QHBoxLayout()
         self.file_button = QPushButton("Select File")
@@ -149,10 +243,16 @@ class AIPlaygroundGUI(QMainWindow):
         batch_layout.addWidget(self.batch_label)
         layout.addLayout(batch_layout)
 
-        # Process button
+        # Process and Cancel buttons
+        process_layout = QHBoxLayout()
         self.process_button = QPushButton("Process")
         self.process_button.clicked.connect(self.process_request)
-        layout.addWidget(self.process_button)
+        process_layout.addWidget(self.process_button)
+        self.cancel_request_button = QPushButton("Cancel")
+        self.cancel_request_button.clicked.connect(self.cancel_request)
+        self.cancel_request_button.setEnabled(False)
+        process_layout.addWidget(self.cancel_request_button)
+        layout.addLayout(process_layout)
 
         # Progress bar
         self.progress_bar = QProgressBar()
@@ -221,6 +321,9 @@ class AIPlaygroundGUI(QMainWindow):
             self.playground.context_dir = None
             self.context_label.setText("No Context Directory Selected")
 
+    def toggle_retrieval(self, checked):
+        self.playground.retrieval = checked
+
     def select_batch_directory(self):
         dir_path = QFileDialog.getExistingDirectory(self, "Select Batch Directory")
         if dir_path:
@@ -253,86 +356,141 @@ class AIPlaygroundGUI(QMainWindow):
     
             print(f"Image skip: {image_skip}")
             print(f"Include chat history: {include_history}") 
-    
+
+            request = dict(
+                prompt=prompt,
+                dev=dev,
+                model_name=model,
+                max_tokens=int(self.max_tok_input.text()),
+                include_chat_history=include_history,
+                image_skip=image_skip
+            )
             if self.batch_dir:
-                self.progress_bar.setVisible(True)
-                self.progress_bar.setMaximum(100)
-                batch_results = self.playground.batch_process(
-                    self.batch_dir,
-                    prompt,
-                    dev,
-                    model_name=model,
-                    max_tokens=int(self.max_tok_input.text()),
-                    include_chat_history=include_history,
-                    image_skip=image_skip
-                )
-        
-                total_files = len(batch_results)
-                html_output = ""
-        
-                for i, (file_path, response) in enumerate(batch_results.items()):
-                    html_output += f"<h3>File: {file_path}</h3>"
-                    html_output += self.markdown_to_html(response)
-                    html_output += "<hr>"
-                    if (i + 1) % max(1, total_files // 20) == 0:  # Update every 5% of progress
-                        progress_value = int((i + 1) / total_files * 100)
-                        self.progress_bar.setValue(progress_value)
-                        QApplication.processEvents()
-                self.output_widget.append(html_output)
-                self.progress_bar.setVisible(False)
-            
+                total_files = len(self.playground.batch_files(self.batch_dir))
+                self.progress_bar.setMaximum(max(1, total_files))
+                self.progress_bar.setValue(0)
             else:
-                response = self.playground.process_prompt(
-                    prompt=prompt,
-                    dev=dev,
-                    file_path=self.file_path,
-                    model_name=model,
-                    max_tokens=int(self.max_tok_input.text()),
-                    include_chat_history=include_history,
-                    image_skip=image_skip
-                )
-                
-                # Handle image generation models
-                if model == "dall-e-3":
-                    self.handle_image_response(response)
-                    self.playground.conversation.add_message("Assistant", "Generated image", response)
-                else:
-                    # Split the response into image summaries and content summary if applicable
-                    if "Image summaries:" in response and "Content summary:" in response:
-                        parts = response.split("Content summary:", 1)
-                        image_summaries = parts[0].replace("Image summaries:", "").strip()
-                        content_summary = parts[1].strip()
-                        
-                        html_response = f"<strong>Image Summaries:</strong><br>{self.markdown_to_html(image_summaries)}<br><br>"
-                        html_response += f"<strong>Content Summary:</strong><br>{self.markdown_to_html(content_summary)}"
-                    else:
-                        html_response = self.markdown_to_html(response)
-                    
-                    # Handle images in the response
-                    if "http://" in response or "https://" in response:
-                        urls = [word for word in response.split() if word.startswith(('http://', 'https://'))]
-                        for url in urls:
-                            html_response = html_response.replace(url, f'<img src="{url}" />')
-                    elif "file://" in response:
-                        file_paths = [word for word in response.split() if word.startswith('file://')]
-                        for file_path in file_paths:
-                            html_response = html_response.replace(file_path, self.embed_image(file_path[7:]))
-                    
-                    # Append only the assistant's response to the output
-                    self.output_widget.append(f"<strong>Assistant:</strong> {html_response}")
-                    self.output_widget.append("<hr>")
-                    
-                    # Add only the assistant's response to the conversation history
-                    self.playground.conversation.add_message("Assistant", response)
-    
-            # Scroll to the bottom of the output widget
-            self.output_widget.verticalScrollBar().setValue(
-                self.output_widget.verticalScrollBar().maximum()
-            )
+                request["file_path"] = self.file_path
+                request["use_cache"] = not self.skip_cache_checkbox.isChecked()
+                self.progress_bar.setMaximum(0)  # Busy indicator until the answer is complete
+                cursor = self.output_widget.textCursor()
+                cursor.movePosition(QTextCursor.MoveOperation.End)
+                self.stream_start = cursor.position()
+                cursor.insertBlock()
         except Exception as e:
             self.output_widget.append(f"<p style='color: red;'>Error: {str(e)}</p>")
-            print(f"Error in process_request: {str(e)}")  # Add this line for debugging
+            print(f"Error in process_request: {str(e)}")
+            return
+
+        # The request runs on a worker thread so the window stays responsive
+        self.worker = RequestWorker(self.playground, request, self.batch_dir)
+        self.worker.chunk.connect(self.on_chunk)
+        self.worker.batch_result.connect(self.on_batch_result)
+        self.worker.response.connect(self.on_response)
+        self.worker.usage.connect(self.on_usage)
+        self.worker.failed.connect(self.on_request_failed)
+        self.worker.finished.connect(self.on_request_finished)
+        self.running_workers.add(self.worker)
+        self.process_button.setEnabled(False)
+        self.cancel_request_button.setEnabled(True)
+        self.progress_bar.setVisible(True)
+        self.worker.start()
+
+    def cancel_request(self):
+        if self.worker:
+            self.worker.cancel()
+            self.output_widget.append("<p><em>Request cancelled.</em></p>")
+            self.reset_request_ui()
+
+    def is_current(self):
+        # Signals from a cancelled worker that is still winding down are ignored
+        return self.sender() is self.worker and not self.worker.cancelled
+
+    def on_chunk(self, chunk):
+        if not self.is_current():
+            return
+        cursor = self.output_widget.textCursor()
+        cursor.movePosition(QTextCursor.MoveOperation.End)
+        cursor.insertText(chunk)
+
+    def on_batch_result(self, file_path, response):
+        if not self.is_current():
+            return
+        self.output_widget.append(f"<h3>File: {file_path}</h3>{self.markdown_to_html(response)}<hr>")
+        self.progress_bar.setValue(self.progress_bar.value() + 1)
+
+    def on_response(self, response):
+        if not self.is_current():
+            return
+        # Swap the raw streamed text for the rendered answer
+        cursor = self.output_widget.textCursor()
+        cursor.setPosition(self.stream_start)
+        cursor.movePosition(QTextCursor.MoveOperation.End, QTextCursor.MoveMode.KeepAnchor)
+        cursor.removeSelectedText()
+        self.show_response(response, self.worker.request["model_name"])
+
+    def on_usage(self, usage):
+        if not self.is_current():
+            return
+        self.output_widget.append(f"<p style='color: gray; font-size: small;'>{usage}</p>")
+
+    def on_request_failed(self, error):
+        if not self.is_current():
+            return
+        self.output_widget.append(f"<p style='color: red;'>Error: {error}</p>")
+        print(f"Error in process_request: {error}")
+
+    def on_request_finished(self):
+        self.running_workers.discard(self.sender())
+        if self.sender() is self.worker and not self.worker.cancelled:
+            self.reset_request_ui()
+
+    def reset_request_ui(self):
+        self.process_button.setEnabled(True)
+        self.cancel_request_button.setEnabled(False)
+        self.progress_bar.setVisible(False)
+        self.progress_bar.setMaximum(100)
+        # Scroll to the bottom of the output widget
+        self.output_widget.verticalScrollBar().setValue(
+            self.output_widget.verticalScrollBar().maximum()
+        )
+
+    def show_response(self, response, model):
+        # Handle image generation models
+        if model == "dall-e-3":
+            self.handle_image_response(response)
+            self.playground.conversation.add_message("Assistant", "Generated image", response)
+            return
+
+        # Split the response into image summaries and content summary if applicable
+        if "Image summaries:" in response and "Content summary:" in response:
+            parts = response.split("Content summary:", 1)
+            image_summaries = parts[0].replace("Image summaries:", "").strip()
+            content_summary = parts[1].strip()
+            
+            html_response = f"<strong>Image Summaries:</strong><br>{self.markdown_to_html(image_summaries)}<br><br>"
+            html_response += f"<strong>Content Summary:</strong><br>{self.markdown_to_html(content_summary)}"
+        else:
+            html_response = self.markdown_to_html(response)
+        
+        # Handle images in the response
+        if "http://" in response or "https://" in response:
+            urls = [word for word in response.split() if word.startswith(('http://', 'https://'))]
+            for url in urls:
+                html_response = html_response.replace(url, f'<img src="{url}" />')
+        elif "file://" in response:
+            file_paths = [word for word in response.split() if word.startswith('file://')]
+            for file_path in file_paths:
+                html_response = html_response.replace(file_path, self.embed_image(file_path[7:]))
         
+        # Append only the assistant's response to the output
+        self.output_widget.append(f"<strong>Assistant:</strong> {html_response}")
+        self.output_widget.append("<hr>")
+        
+        # Add only the assistant's response to the conversation history
+        with self.playground.history_lock:
+            self.playground.conversation.add_message("Assistant", response)
+
     def handle_image_response(self, response):
         print(f"Handling image response: {response[:100]}...")  # Add this line for debugging
         if isinstance(response, str) and response.startswith("http"):
@@ -475,11 +633,19 @@ class AIPlaygroundGUI(QMainWindow):
         return f'<img src="data:image/png;base64,{encoded_string}" />'
 
     def closeEvent(self, event):
+        for worker in list(self.running_workers):
+            worker.cancel()
+            worker.wait(2000)
         self.clear_output()
         event.accept()  # Accept the event to close the window
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
     window = AIPlaygroundGUI()
+    if os.environ.get("STARTUP_BENCHMARK"):
+        first_paint_timer = FirstPaintTimer()
+        window.installEventFilter(first_paint_timer)
     window.show()
+    # Old extracted images are cleaned up in the background once the window is up
+    start_garbage_collection()
     sys.exit(app.exec())
\ No newline at end of file
@@ -1,10 +1,14 @@
-from mistralai.client import MistralClient
 from mistralai.models.chat_completion import ChatMessage
 import os
 import json
-from prep_file import combine_json, extract_text_content, context_directory
+from prep_file import ExtractedContent
+from clients import get_client
+from prompt_layout import PromptLayout
 
-def mistral_api(prompt, file_path=None, context_dir=None, model_name='nemo', max_tokens=500,   chat_history=None, ):
+# Sampling settings sent with every call (also part of the response cache key)
+SAMPLING = {"temperature": 0.3}
+
+def mistral_api(prompt, file_path=None, context_dir=None, model_name='nemo', max_tokens=500, chat_history=None, extracted=None, stream=False):
     print(f"Mistral API called with prompt: {prompt[:100]}...")
     print(f"File path: {file_path}")
     print(f"Context directory: {context_dir}")
@@ -21,38 +25,36 @@ def mistral_api(prompt, file_path=None, context_dir=None, model_name='nemo', max
     api_key = os.environ.get("MISTRAL_API_KEY")
     if not api_key:
         raise ValueError("MISTRAL_API_KEY environment variable not set")
-    client = MistralClient(api_key=api_key)
-
-    # Process context directory
-    context_content = ""
-    if context_dir:
-        print("Processing context_dir")
-        context_json_file = context_directory(context_dir, image_skip=True, use_cache=True)
-        print(f"Context JSON file keys: {list(context_json_file.keys())}")
-        context_content = extract_text_content(context_json_file)
-
-    # Process file path
-    file_content = ""
-    if file_path:
-        json_file = combine_json(file_path, image_skip=True)
-        file_content = extract_text_content(json_file)
-
-    # Combine content
-    message_content = f"Context: {context_content}\nFile: {file_content}".strip()
-    print(f"Final message_content: {message_content[:500]}...")
+    client = get_client('mistral')
 
-    # Add chat history to the prompt
-    if chat_history:
-        prompt = f"Previous conversation:\n{chat_history}\n\nCurrent prompt: {prompt}"
+    # Reuse the request's extraction, only extracting here when called standalone
+    if extracted is None:
+        extracted = ExtractedContent.build(file_path, context_dir, image_skip=True)
+    context_content = extracted.context_text
+    file_content = extracted.file_text
 
     # Construct message and generate response
-    msg_content = f"Prompt: [ {prompt} ], Content: [ {message_content} ]"
-    messages = [ChatMessage(role="user", content=msg_content)]
+    layout = PromptLayout(prompt, context_content, file_content, chat_history)
+    messages = [ChatMessage(role=msg["role"], content=msg["content"]) for msg in layout.messages()]
+    print(f"Final message_content: {messages[-1].content[:500]}...")
+
+    if stream:
+        def stream_content():
+            for chunk in client.chat_stream(
+                model=full_model_name,
+                messages=messages,
+                temperature=SAMPLING["temperature"],
+                safe_prompt=False,
+                max_tokens=max_tokens
+            ):
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        return stream_content()
     
     chat_response = client.chat(
         model=full_model_name,
         messages=messages,
-        temperature=0.3,
+        temperature=SAMPLING["temperature"],
         safe_prompt=False,
         max_tokens=max_tokens
     )
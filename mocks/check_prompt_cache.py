@@ -0,0 +1,53 @@
+"""Checks provider prompt caching against the local API stand-ins.
+
+Run from the repository root: python mocks/check_prompt_cache.py
+"""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["PROMPT_CACHING"] = "1"
+
+from fake_apis import install, FakeCachedContent, FakeGenerativeModel
+
+def main():
+    os.chdir(tempfile.mkdtemp())
+    anthropic, _ = install()
+    import model_interact
+    from prep_file import ExtractedContent
+
+    # Over Gemini's 32k-token minimum for cached contents
+    context_text = " ".join(f"fact{i % 997}" for i in range(40000))
+    extracted = ExtractedContent(context_json={"context.txt": {}}, context_text=context_text)
+    playground = model_interact.AIPlayground(history_file="history.json")
+
+    for question in ("First question?", "Second question?"):
+        playground.process_prompt(question, 'anthropic', model_name='claude-3-5-sonnet-20240620', extracted=extracted, use_cache=False)
+    first, second = [call["system"][-1] for call in anthropic.calls]
+    assert first["cache_control"] == {"type": "ephemeral"} and first == second
+    assert all(context_text not in call["messages"][0]["content"][0]["text"] for call in anthropic.calls)
+    assert "hit" in playground.last_token_usage["prompt_cache"], playground.last_token_usage
+    print("Claude: cache written on the first call and read on the second")
+
+    # The GUI streams its answers, which reports cache usage from the final message
+    streamed = ExtractedContent(context_json={"context.txt": {}}, context_text=context_text + " streamed")
+    statuses = []
+    for question in ("First question?", "Second question?"):
+        answer = "".join(playground.stream_prompt(question, 'anthropic', model_name='claude-3-5-sonnet-20240620', extracted=streamed, use_cache=False))
+        assert answer == "answer", answer
+        statuses.append(playground.last_token_usage["prompt_cache"])
+    assert "miss" in statuses[0] and "hit" in statuses[1], statuses
+    print("Claude streaming: cache written on the first call and read on the second")
+
+    for question in ("First question?", "Second question?"):
+        playground.process_prompt(question, 'google', model_name='flash', extracted=extracted, use_cache=False)
+    assert len(FakeCachedContent.created) == 1, FakeCachedContent.created
+    handles = [cached for cached, _ in FakeGenerativeModel.calls]
+    assert handles == [FakeCachedContent.created[0]] * 2, handles
+    assert all(context_text not in "".join(contents) for _, contents in FakeGenerativeModel.calls)
+    assert "hit" in playground.last_token_usage["prompt_cache"], playground.last_token_usage
+    print("Gemini: one CachedContent created and reused")
+
+if __name__ == "__main__":
+    main()
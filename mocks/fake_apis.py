@@ -0,0 +1,99 @@
+"""Local stand-ins for the Anthropic and Gemini SDKs, for checking prompt caching offline.
+
+install() puts them where clients.get_client() finds them; they record every
+call and report cache usage the way the real APIs do.
+"""
+import sys
+import types
+from types import SimpleNamespace
+
+class FakeAnthropic:
+    """Anthropic client whose cache holds each system block marked cache_control."""
+
+    def __init__(self):
+        self.calls = []
+        self.cached = set()
+        self.messages = self
+
+    def _usage(self, kwargs):
+        read = written = 0
+        for block in kwargs.get("system") or []:
+            if isinstance(block, dict) and block.get("cache_control"):
+                tokens = len(block["text"]) // 4
+                if block["text"] in self.cached:
+                    read += tokens
+                else:
+                    self.cached.add(block["text"])
+                    written += tokens
+        return SimpleNamespace(cache_read_input_tokens=read, cache_creation_input_tokens=written)
+
+    def create(self, **kwargs):
+        self.calls.append(kwargs)
+        return SimpleNamespace(content=[SimpleNamespace(text="answer")], usage=self._usage(kwargs))
+
+    def stream(self, **kwargs):
+        self.calls.append(kwargs)
+        return FakeMessageStream(["ans", "wer"], self._usage(kwargs))
+
+class FakeMessageStream:
+    """What messages.stream() returns: a context manager with text_stream and get_final_message()."""
+
+    def __init__(self, chunks, usage):
+        self.text_stream = iter(chunks)
+        self.usage = usage
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def get_final_message(self):
+        return SimpleNamespace(content=[SimpleNamespace(text="answer")], usage=self.usage)
+
+class FakeCachedContent:
+    created = []
+
+    @classmethod
+    def create(cls, model, contents, ttl, system_instruction=None):
+        handle = SimpleNamespace(name=f"cachedContents/{len(cls.created) + 1}", model=model, contents=contents, ttl=ttl)
+        cls.created.append(handle)
+        return handle
+
+class FakeGenerativeModel:
+    calls = []
+
+    def __init__(self, model_name=None, generation_config=None, cached_content=None):
+        self.model_name = model_name
+        self.cached_content = cached_content
+
+    @classmethod
+    def from_cached_content(cls, cached_content, generation_config=None):
+        return cls(cached_content.model, generation_config, cached_content)
+
+    def generate_content(self, contents, stream=False):
+        FakeGenerativeModel.calls.append((self.cached_content, contents))
+        cached_tokens = sum(len(text) for text in self.cached_content.contents) // 4 if self.cached_content else 0
+        return SimpleNamespace(text="answer", usage_metadata=SimpleNamespace(cached_content_token_count=cached_tokens))
+
+def fake_genai():
+    genai = types.ModuleType("google.generativeai")
+    genai.GenerativeModel = FakeGenerativeModel
+    genai.configure = lambda **kwargs: None
+    caching = types.ModuleType("google.generativeai.caching")
+    caching.CachedContent = FakeCachedContent
+    genai.caching = caching
+    return genai
+
+def install():
+    """Replace the Anthropic and Gemini clients; returns (anthropic, genai)."""
+    import clients
+    anthropic = FakeAnthropic()
+    genai = fake_genai()
+    sys.modules.setdefault("google", types.ModuleType("google"))
+    sys.modules["google.generativeai"] = genai
+    sys.modules["google.generativeai.caching"] = genai.caching
+    clients.reset_clients()
+    clients._clients["anthropic"] = anthropic
+    clients._clients["google"] = genai
+    return anthropic, genai
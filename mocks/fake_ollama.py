@@ -0,0 +1,67 @@
+"""Local stand-in for an Ollama server, for measuring prompt prefill offline.
+
+Each model keeps one KV slot, like llama.cpp with cache_prompt: a request only
+evaluates the tokens after the longest prefix it shares with the previous
+prompt and answer, and reports that count as prompt_eval_count. Tokens are
+whitespace-separated words.
+
+    python mocks/fake_ollama.py [port]
+"""
+import json
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+def render(messages):
+    return "".join(f"<|{m['role']}|> {m['content']} <|end|> " for m in messages) + "<|assistant|> "
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    slots = {}
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        self.end_headers()
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        chat = self.path == '/api/chat'
+        prompt = render(body['messages']) if chat else f"<|user|> {body['prompt']} <|end|> <|assistant|> "
+        tokens = prompt.split()
+        answer = f"answer with {len(tokens)} prompt tokens seen"
+        with self.lock:
+            cached = self.slots.get(body['model'], [])
+            common = 0
+            for new, old in zip(tokens, cached):
+                if new != old:
+                    break
+                common += 1
+            self.slots[body['model']] = tokens + answer.split()
+        done = {
+            "model": body['model'],
+            "created_at": "2024-01-01T00:00:00Z",
+            "done": True,
+            "done_reason": "stop",
+            "prompt_eval_count": len(tokens) - common,
+            "eval_count": len(answer.split()),
+        }
+        if chat:
+            done["message"] = {"role": "assistant", "content": answer}
+        else:
+            done["response"] = answer
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(done).encode())
+
+def serve(port=0):
+    # Serves from a daemon thread; port 0 picks a free port
+    server = ThreadingHTTPServer(('127.0.0.1', port), FakeOllamaHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    ThreadingHTTPServer(('127.0.0.1', int(sys.argv[1]) if len(sys.argv) > 1 else 11434), FakeOllamaHandler).serve_forever()
@@ -1,21 +1,52 @@
-from google_method import gemini_api
-from mistral_method import mistral_api
-from openai_method import gpt_api
-from claude_method import claude_api
-from ollama_method import ollama_api 
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Iterator, AsyncIterator
 from read_json_text import extract_json_text
-from prep_file import combine_json, context_directory, extract_text_content, ContextCache
+from prep_file import combine_json, extract_files, file_hash, ContextCache, ExtractedContent
+from batch_executor import run_concurrent, BatchCheckpoint
+from response_cache import ResponseCache, StreamError
+from retrieval import ContextIndex, format_chunks
+from token_budget import fit_prompt, format_usage
+from history_summary import RollingSummary, format_history, trim_history_messages
+from prompt_cache import prompt_caches, context_hash
+from prompt_layout import PromptLayout, prompt_prefixes, format_prefix_match
+from context_watcher import ContextWatcher
+from image_summary import image_hash
 import markdown2
 import webbrowser
 import os
 import json
 import glob
-import tempfile
 import base64
 from PIL import Image
 import io
 import requests
+import threading
+import asyncio
+import importlib
+
+# Provider module and API function per dev option. A provider module, and the
+# SDK it imports, is only loaded the first time that provider is called.
+PROVIDERS = {
+    'google': ('google_method', 'gemini_api'),
+    'mistral': ('mistral_method', 'mistral_api'),
+    'openai': ('openai_method', 'gpt_api'),
+    'anthropic': ('claude_method', 'claude_api'),
+    'ollama': ('ollama_method', 'ollama_api'),
+}
+
+def get_provider(dev):
+    if dev not in PROVIDERS:
+        raise ValueError(f"Invalid dev option: {dev}")
+    return importlib.import_module(PROVIDERS[dev][0])
+
+def provider_api(dev):
+    return getattr(get_provider(dev), PROVIDERS[dev][1])
+
+def provider_sampling(dev):
+    # Sampling settings are part of the response cache key
+    return get_provider(dev).SAMPLING
+
+# Image generation returns short-lived URLs, so those calls are never cached
+UNCACHED_MODELS = ['dall-e-3']
 
 class Conversation:
     def __init__(self):
@@ -45,11 +76,11 @@ def model_playground(
     
     def generate_response(current_prompt: str, chat_history_images: List[Image.Image]) -> str:
         if dev == 'google':
-            response = gemini_api(current_prompt, file_path, context_dir, model_name or 'gemini-1.5-flash', max_tokens, chat_history_images)
+            response = provider_api(dev)(current_prompt, file_path, context_dir, model_name or 'gemini-1.5-flash', max_tokens, chat_history_images)
         elif dev == 'openai':
-            response = gpt_api(current_prompt, file_path, context_dir, model_name or 'mini', max_tokens, chat_history_images)
+            response = provider_api(dev)(current_prompt, file_path, context_dir, model_name or 'mini', max_tokens, chat_history_images)
         elif dev == 'mistral':
-            response = mistral_api(current_prompt, file_path, context_dir, model_name or 'mistral-large-latest', max_tokens)
+            response = provider_api(dev)(current_prompt, file_path, context_dir, model_name or 'mistral-large-latest', max_tokens)
         else:
             raise ValueError(f"Invalid dev option: {dev}. Choose 'google', 'openai', or 'mistral'.")
         
@@ -81,21 +112,49 @@ def model_playground(
     }
 
 class AIPlayground:
-    def __init__(self, context_dir: str = None, history_file: str = "conversation_history.json"):
+    def __init__(self, context_dir: str = None, history_file: str = "conversation_history.json", response_cache: Optional[ResponseCache] = None):
         self.context_dir = context_dir
-        self.context_cache = ContextCache(context_dir) if context_dir else None
+        # One context cache per (directory, image_skip); each keeps its extractions in memory
+        self.context_caches = {}
+        self.context_lock = threading.Lock()
+        # Watch mode keeps the context cache current in the background (needs watchdog)
+        self.watch_context = os.environ.get("CONTEXT_WATCH", "").lower() in ("1", "true", "yes")
+        # Content hashing keeps the cached extraction of a file that was touched but not changed
+        self.context_content_hash = os.environ.get("CONTEXT_CONTENT_HASH", "").lower() in ("1", "true", "yes")
         self.conversation = Conversation()
         self.history_file = history_file
         self.batch_dir = False
+        self.response_cache = response_cache or ResponseCache()
+        # Batch files are processed concurrently and share the conversation
+        self.history_lock = threading.RLock()
+        # Older history is folded into a rolling summary saved next to the history file
+        self.history_summary = RollingSummary(f"{os.path.splitext(history_file)[0]}_summary.json")
+        # Ollama session mode keeps a stable message prefix so the model reuses its KV cache
+        self.ollama_session = os.environ.get("OLLAMA_SESSION", "").lower() in ("1", "true", "yes")
+        # Retrieval mode sends only the context chunks most relevant to the prompt
+        self.retrieval = os.environ.get("CONTEXT_RETRIEVAL", "").lower() in ("1", "true", "yes")
+        self.context_indexes = {}
+        self.index_lock = threading.Lock()
+        # Token usage of the last prompt sent from each thread
+        self._local = threading.local()
         self.load_history()
-        self.cached_context = self._load_cached_context()
 
-    def _load_cached_context(self):
-        if self.context_cache:
-            cached_context = self.context_cache.get_cached_context()
-            if cached_context:
-                return cached_context
-        return None
+    def _context_cache(self, image_skip=True):
+        context_dir = os.path.abspath(self.context_dir)
+        # Caches of a previous context directory are dropped, with their watchers
+        for key in [key for key in self.context_caches if key[0] != context_dir]:
+            cache = self.context_caches.pop(key)
+            if cache.watcher:
+                cache.watcher.stop()
+        key = (context_dir, image_skip)
+        if key not in self.context_caches:
+            cache = ContextCache(self.context_dir, image_skip=image_skip, use_content_hash=self.context_content_hash)
+            if self.watch_context:
+                watcher = ContextWatcher(self.context_dir, on_change=lambda: self._extract_context(image_skip))
+                if watcher.start():
+                    cache.watcher = watcher
+            self.context_caches[key] = cache
+        return self.context_caches[key]
 
     def load_history(self):
         try:
@@ -108,7 +167,7 @@ class AIPlayground:
 
     def save_history(self):
         try:
-            with open(self.history_file, 'w', encoding='utf-8') as f:
+            with self.history_lock, open(self.history_file, 'w', encoding='utf-8') as f:
                 json.dump(self.conversation.messages, f, ensure_ascii=False, indent=4)
         except IOError as e:
             print(f"Error saving history: {e}")
@@ -116,69 +175,197 @@ class AIPlayground:
     def clear_history(self):
         self.conversation = Conversation()
         self.save_history()
+        self.history_summary.reset()
         print("Conversation history cleared.")
 
-    def batch_process(self, directory, prompt, dev, model_name, max_tokens=1000, include_chat_history=True, file_pattern="*.*", image_skip=True):
-        results = {}
-        for file_path in glob.glob(os.path.join(directory, "**", file_pattern), recursive=True):
-            if os.path.isfile(file_path):
-                try:
-                    combined_json = combine_json(file_path, image_skip=image_skip)
-                    file_content = extract_text_content(combined_json)
-                    
-                    # Minimize prompt construction
-                    file_prompt = f"{prompt}\n\nContent: {file_content}"
-                    response = self.process_prompt(file_prompt, dev, file_path, model_name, max_tokens, include_chat_history, image_skip)
-                    results[file_path] = response
-                except Exception as e:
-                    results[file_path] = f"Error: {str(e)}"
-        return results
-
-    def process_prompt(self, prompt: str, dev: str, file_path: str = None, model_name: str = None, max_tokens: int = 1000, include_chat_history: bool = True, image_skip: bool = True):
-        context = self.cached_context or self.context_dir
-        
-        # Handle context as dictionary
-        if isinstance(context, dict):
-            with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.json') as temp:
-                json.dump(context, temp)
-                context_path = temp.name
-        else:
-            context_path = context
-        
-        # Extract content efficiently
-        content_parts = []
-        
-        # Add file content if exists
-        if file_path:
-            json_file = combine_json(file_path, image_skip=image_skip)
-            file_content = extract_text_content(json_file)
-            if file_content.strip():
-                content_parts.append(file_content)
-    
-        # Add context content if exists
-        if context_path:
-            context_json = context_directory(context_path, image_skip=image_skip, use_cache=True)
-            context_content = extract_text_content(context_json)
-            if context_content.strip():
-                content_parts.append(context_content)
+    def batch_files(self, directory, file_pattern="*.*"):
+        return [p for p in glob.glob(os.path.join(directory, "**", file_pattern), recursive=True) if os.path.isfile(p)]
+
+    def batch_process(self, directory, prompt, dev, model_name, max_tokens=1000, include_chat_history=True, file_pattern="*.*", image_skip=True, max_workers=None):
+        return dict(self.iter_batch(directory, prompt, dev, model_name, max_tokens, include_chat_history, file_pattern, image_skip, max_workers))
+
+    def iter_batch(self, directory, prompt, dev, model_name, max_tokens=1000, include_chat_history=True, file_pattern="*.*", image_skip=True, max_workers=None):
+        """Yield (file_path, response) as each batch file is answered.
+
+        Answers are appended to the directory's BatchCheckpoint as they arrive;
+        files already answered with the same prompt, model, options, content
+        and context are replayed from it instead of being sent again.
+        """
+        checkpoint = BatchCheckpoint(directory)
+        # The context is shared by every file in the batch, so extract it once
+        context_json = self._extract_context(image_skip)
+        context_extracted = ExtractedContent(context_json=context_json, context_text=self._context_text(context_json, prompt, image_skip))
+        options = [prompt, dev, model_name, max_tokens, include_chat_history, image_skip, context_hash(context_extracted.context_text)]
+        todo = {}
+        for file_path in self.batch_files(directory, file_pattern):
+            try:
+                # The path is part of the key, so files with identical content each get an answer
+                key = checkpoint.record_key(os.path.relpath(file_path, directory), file_hash(file_path), *options)
+            except OSError as e:
+                yield file_path, f"Error: {str(e)}"
+                continue
+            todo[key] = file_path
+
+        # Replay answers from an earlier (possibly interrupted) run
+        for record in checkpoint.iter_records():
+            file_path = todo.pop(record.get("key"), None)
+            if file_path:
+                yield file_path, record["response"]
+        if not todo:
+            return
+
+        keys = {file_path: key for key, file_path in todo.items()}
+        errors = []
+
+        def jobs():
+            # Files are extracted in parallel and sent as soon as each is ready
+            for file_path, file_json, error in extract_files(list(keys), image_skip=image_skip, max_workers=max_workers):
+                if error:
+                    errors.append((file_path, f"Error: {str(error)}"))
+                    continue
+                extracted = context_extracted.for_file(file_path, file_json)
+                # Answers go to the checkpoint rather than the chat history
+                yield file_path, self.process_prompt, (prompt, dev, file_path, model_name, max_tokens, include_chat_history, image_skip), {'extracted': extracted, 'record_history': False}
+
+        # API calls run concurrently within the provider's limits
+        for file_path, response, error in run_concurrent(dev, jobs()):
+            while errors:
+                yield errors.pop()
+            if error:
+                yield file_path, f"Error: {str(error)}"
+                continue
+            # Provider errors (including calls aborted by a cancel) come back as text and are retried next run
+            if not response.startswith("Error"):
+                checkpoint.append(keys[file_path], file_path, response)
+            yield file_path, response
+        while errors:
+            yield errors.pop()
+
+    def _extract_context(self, image_skip=True, full_scan=False):
+        # The context stays in memory as extracted; a refresh only re-reads the files that changed
+        if not self.context_dir:
+            return None
+        with self.context_lock:
+            return self._context_cache(image_skip).refresh(full=full_scan)
+
+    def _context_text(self, context_json, query, image_skip=True):
+        # None keeps the full context text; in retrieval mode only the best chunks are kept
+        if not self.retrieval or not context_json or not self.context_dir:
+            return None
+        with self.index_lock:
+            key = (os.path.abspath(self.context_dir), image_skip)
+            index = self.context_indexes.get(key) or ContextIndex(self.context_dir, image_skip=image_skip)
+            self.context_indexes[key] = index.update(context_json)
+        chunks = index.search(query)
+        print(f"Retrieved {len(chunks)} of {len(index.chunks)} context chunks")
+        return format_chunks(chunks)
+
+    def process_prompt(self, prompt: str, dev: str, file_path: str = None, model_name: str = None, max_tokens: int = 1000, include_chat_history: bool = True, image_skip: bool = True, extracted: Optional[ExtractedContent] = None, record_history: bool = True, use_cache: bool = True):
+        image_summaries, content_summary = self._call_provider(prompt, dev, file_path, model_name, max_tokens, include_chat_history, image_skip, extracted, use_cache=use_cache)
+
+        # Combine results efficiently
+        result = content_summary
+        if image_summaries and not image_skip:
+            result = f"{image_summaries}\n\n{content_summary}"
+
+        if record_history:
+            self._record_response(result)
         
-        # Add chat history if needed
+        return result
+
+    def stream_prompt(self, prompt: str, dev: str, file_path: str = None, model_name: str = None, max_tokens: int = 1000, include_chat_history: bool = True, image_skip: bool = True, extracted: Optional[ExtractedContent] = None, record_history: bool = True, use_cache: bool = True) -> Iterator[str]:
+        """Yield the response in chunks as the provider produces them.
+
+        Takes the same arguments as process_prompt. The full response is
+        recorded in the history once the stream is exhausted.
+        """
+        image_summaries, content_stream = self._call_provider(prompt, dev, file_path, model_name, max_tokens, include_chat_history, image_skip, extracted, stream=True, use_cache=use_cache)
+
+        # Providers return a plain string for errors and non-text results
+        if isinstance(content_stream, str):
+            content_stream = iter([content_stream])
+
+        chunks = []
+        if image_summaries and not image_skip:
+            chunks.append(f"{image_summaries}\n\n")
+            yield chunks[-1]
+        try:
+            for chunk in content_stream:
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            # Stops the provider's stream when the caller stops early
+            if hasattr(content_stream, 'close'):
+                content_stream.close()
+
+        if record_history:
+            self._record_response("".join(chunks))
+
+    async def astream_prompt(self, *args, **kwargs) -> AsyncIterator[str]:
+        """Async iterator over stream_prompt; the blocking provider calls run in a worker thread."""
+        loop = asyncio.get_running_loop()
+        chunks = self.stream_prompt(*args, **kwargs)
+        done = object()
+        try:
+            while True:
+                chunk = await loop.run_in_executor(None, next, chunks, done)
+                if chunk is done:
+                    break
+                yield chunk
+        finally:
+            chunks.close()
+
+    @property
+    def last_token_usage(self):
+        usage = getattr(self._local, 'token_usage', None)
+        if usage is None:
+            return None
+        return {**usage, "prompt_cache": prompt_caches.last_status(), "prefix_match": getattr(self._local, 'prefix_match', None)}
+
+    def _record_response(self, result):
+        with self.history_lock:
+            self.conversation.add_message("Assistant", result)
+            self.save_history()
+
+    def _call_provider(self, prompt, dev, file_path=None, model_name=None, max_tokens=1000, include_chat_history=True, image_skip=True, extracted=None, stream=False, use_cache=True):
+        prompt_caches.clear_status()
+        self._local.prefix_match = None
+        # Extract file and context once; the providers reuse this result
+        if extracted is None:
+            file_json = combine_json(file_path, image_skip=image_skip) if file_path else None
+            context_json = self._extract_context(image_skip)
+            extracted = ExtractedContent(file_path, file_json, context_json, self._context_text(context_json, prompt, image_skip))
+
+        chat_history = ""
+        history_summary, recent_messages = "", []
         if include_chat_history:
-            chat_history = self.conversation.get_full_conversation()
-            if chat_history.strip():
-                content_parts.append(chat_history)
-        
-        # Add prompt
-        if prompt.strip():
-            content_parts.append(f"User: {prompt}")
-        
-        # Combine all parts efficiently
-        full_content = "\n\n".join(content_parts)
+            with self.history_lock:
+                messages = list(self.conversation.messages)
+            # Only the last turns go in verbatim, after a summary of the rest
+            history_summary, recent_messages = self.history_summary.update(
+                messages, lambda summary_prompt: self._summarize_history(summary_prompt, dev, model_name))
+            chat_history = format_history(history_summary, recent_messages)
+
+        # Trim context, then the oldest history, then the file to fit the model's window
+        texts, usage = fit_prompt(dev, model_name, max_tokens, {
+            'file': (extracted.file_text, 'start'),
+            'context': (extracted.context_text, 'start'),
+            'history': (chat_history, 'end'),
+            'prompt': (f"User: {prompt}" if prompt.strip() else "", 'start'),
+        })
+        self._local.token_usage = usage
+        print(f"Token usage: {format_usage(usage)}")
+        if texts['file'] != extracted.file_text or texts['context'] != extracted.context_text:
+            extracted = extracted.with_text(texts['file'], texts['context'])
+
+        # The providers assemble the same layout: system, context, file, history, question
+        layout = PromptLayout(prompt, extracted.context_text, extracted.file_text, texts['history'])
+        full_content = layout.text(system=True)
         
         # Process images if needed (only if image_skip is False)
         chat_history_images = []
         if include_chat_history and not image_skip:
-            for message in self.conversation.messages:
+            for message in recent_messages:
                 if 'image' in message:
                     if message['image'].startswith('http'):
                         response = requests.get(message['image'])
@@ -188,40 +375,87 @@ class AIPlayground:
                         image = Image.open(io.BytesIO(image_data))
                     chat_history_images.append(image)
     
-        # Call API with image_skip parameter
-        if dev == 'google':
-            image_summaries, content_summary = gemini_api(full_content, file_path, context_path, model_name, max_tokens, chat_history_images, image_skip=image_skip)
-        elif dev == 'openai':
-            image_summaries, content_summary = gpt_api(full_content, file_path, context_path, model_name, max_tokens, chat_history_images, image_skip=image_skip)
-        elif dev == 'mistral':
-            image_summaries, content_summary = "", mistral_api(full_content, file_path, context_path, model_name, max_tokens)
-        elif dev == 'anthropic':
-            image_summaries, content_summary = claude_api(full_content, file_path, context_path, model_name, max_tokens, chat_history_images, image_skip=image_skip)
-        elif dev == 'ollama':
-            image_summaries, content_summary = ollama_api(full_content, file_path, context_path, model_name, max_tokens, chat_history_images, image_skip=image_skip)
-        else:
-            raise ValueError(f"Invalid dev option: {dev}")
+        # Identical calls are answered from the response cache
+        cache_key = None
+        if use_cache and model_name not in UNCACHED_MODELS:
+            cache_key = self.response_cache.make_key(
+                dev=dev,
+                model=model_name,
+                max_tokens=max_tokens,
+                sampling=provider_sampling(dev),
+                image_skip=image_skip,
+                prompt=context_hash(full_content),
+                file=context_hash(extracted.file_text),
+                context=context_hash(extracted.context_text),
+                images=[] if image_skip else [image_hash(image) for image in extracted.image_paths() + chat_history_images]
+            )
+            cached = self.response_cache.get(cache_key)
+            if cached:
+                print("Response cache hit.")
+                return cached[0], cached[1]
 
-        # Combine results efficiently
-        result = content_summary
-        if image_summaries and not image_skip:
-            result = f"{image_summaries}\n\n{content_summary}"
+        prefix_match = prompt_prefixes.record(dev, model_name, full_content)
+        self._local.prefix_match = prefix_match
+        if prefix_match:
+            print(f"Prompt prefix: {format_prefix_match(prefix_match)}")
 
-        self.conversation.add_message("Assistant", result)
-        self.save_history()
-        
-        # Cleanup temp file if created
-        if isinstance(context, dict) and 'temp' in locals():
-            os.unlink(temp.name)
-        
-        return result
+        # The same trimmed history as chat messages, for Ollama's session mode
+        history = trim_history_messages(history_summary, recent_messages, texts['history'])
+        image_summaries, content_summary = self._dispatch(dev, prompt, file_path, model_name, max_tokens, chat_history_images, image_skip, extracted, stream, chat_history=texts['history'], history=history)
+        if not cache_key:
+            return image_summaries, content_summary
+        if stream and not isinstance(content_summary, str):
+            return image_summaries, self._cache_stream(cache_key, image_summaries, content_summary)
+        self._cache_response(cache_key, image_summaries, content_summary)
+        return image_summaries, content_summary
+
+    def _summarize_history(self, summary_prompt, dev, model_name):
+        # Set HISTORY_SUMMARY_DEV and HISTORY_SUMMARY_MODEL together to use a cheaper model
+        dev = os.environ.get("HISTORY_SUMMARY_DEV") or dev
+        model_name = os.environ.get("HISTORY_SUMMARY_MODEL") or model_name
+        if model_name in UNCACHED_MODELS:
+            return None  # Image models cannot summarize; the history stays verbatim
+        _, summary = self._dispatch(dev, summary_prompt, None, model_name, 400, [], True, ExtractedContent())
+        return summary
+
+    def _cache_response(self, cache_key, image_summaries, content_summary):
+        # Provider errors come back as text and must not be replayed
+        if content_summary and not content_summary.startswith("Error"):
+            self.response_cache.put(cache_key, [image_summaries, content_summary])
+
+    def _cache_stream(self, cache_key, image_summaries, chunks):
+        # Only a stream that ran to completion without a StreamError is cached
+        parts = []
+        failed = False
+        try:
+            for chunk in chunks:
+                failed = failed or isinstance(chunk, StreamError)
+                parts.append(chunk)
+                yield chunk
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+        if not failed:
+            self._cache_response(cache_key, image_summaries, "".join(parts))
+
+    def _dispatch(self, dev, question, file_path, model_name, max_tokens, chat_history_images, image_skip, extracted, stream=False, chat_history=None, history=None):
+        # Call API with the shared extraction and image_skip parameter; the
+        # provider lays out the question, history and extracted text itself
+        api = provider_api(dev)
+        if dev == 'ollama':
+            # In session mode the history goes as chat messages so the message prefix stays stable
+            history = history if self.ollama_session and history else None
+            return api(question, file_path, None, model_name, max_tokens, chat_history_images, chat_history, image_skip=image_skip, extracted=extracted, stream=stream, session=self.ollama_session, history_messages=history)
+        if dev == 'mistral':
+            return "", api(question, file_path, None, model_name, max_tokens, chat_history=chat_history, extracted=extracted, stream=stream)
+        return api(question, file_path, None, model_name, max_tokens, chat_history=chat_history, chat_history_images=chat_history_images, image_skip=image_skip, extracted=extracted, stream=stream)
 
     def update_context(self):
-        if self.context_cache and self.context_dir:
-            self.cached_context = context_directory(self.context_dir, use_cache=True)
+        if self.context_dir:
+            self._extract_context(full_scan=True)
             print("Context updated.")
         else:
-            print("No context directory specified or context cache not initialized.")
+            print("No context directory specified.")
 
     def _print_response(self, dev: str, prompt: str, response: str):
         print(f"\n{dev.capitalize()} Response to '{prompt}':")
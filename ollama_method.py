@@ -1,12 +1,32 @@
-import ollama
 from typing import Optional, List, Dict
-from prep_file import combine_json, context_directory, extract_text_content, extract_image_directory_from_json
+from prep_file import ExtractedContent
+from clients import get_client
+from response_cache import StreamError
+from image_summary import describe_images, image_label, IMAGE_PROMPT
+from image_prep import prepare_image_base64
+from prompt_layout import PromptLayout
+from token_budget import context_limit
 from pathlib import Path
-from ollama import generate
-import base64
-import json
+import os
 
-def ollama_api(prompt: str, file_path: Optional[str] = None, context_dir: Optional[str] = None, model_name: str = 'llama2', max_tokens: int = 1000, chat_history_images: Optional[List] = None, chat_history: Optional[str] = None, image_skip: bool = False) -> tuple[str, str]:
+# Sampling settings sent with every call (also part of the response cache key)
+SAMPLING = {'temperature': 0.4}
+
+# Vision model used to describe images for every Ollama model
+VISION_MODEL = 'minicpm-v:latest'
+
+# How long Ollama keeps a model (and its KV cache) loaded after a session call
+KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "30m")
+
+def report_prefill(response):
+    # prompt_eval_count is the number of prompt tokens Ollama actually evaluated;
+    # tokens of a prefix still in its KV cache are not counted
+    prefill = response.get('prompt_eval_count')
+    if prefill is not None:
+        print(f"Ollama prefill: {prefill} prompt tokens evaluated")
+    return prefill
+
+def ollama_api(prompt: str, file_path: Optional[str] = None, context_dir: Optional[str] = None, model_name: str = 'llama2', max_tokens: int = 1000, chat_history_images: Optional[List] = None, chat_history: Optional[str] = None, image_skip: bool = False, extracted: Optional[ExtractedContent] = None, stream: bool = False, session: bool = False, history_messages: Optional[List[Dict]] = None) -> tuple:
     print(f"Ollama API called with prompt: {prompt[:100]}...")
     print(f"File path: {file_path}")
     print(f"Context directory: {context_dir}")
@@ -24,52 +44,33 @@ def ollama_api(prompt: str, file_path: Optional[str] = None, context_dir: Option
         'qwen-2.5': 'qwen2.5:7b-instruct-q8_0 '
     }
     full_model_name = model_name_mapping.get(model_name, model_name)
+    client = get_client('ollama')
 
     def process_image(img_path):
         try:
-            with open(img_path, "rb") as image_file:
-                return base64.b64encode(image_file.read()).decode("utf-8")
+            # Downscaled and recompressed for the vision model
+            return prepare_image_base64(img_path, 'ollama')[0]
         except Exception as e:
             print(f"Error processing image {img_path}: {str(e)}")
             return None
 
-    # Process file content
-    file_content = ""
-    if file_path:
+    # Reuse the request's extraction, only extracting here when called standalone
+    if extracted is None:
         try:
-            json_file = combine_json(file_path, image_skip=image_skip)
-            file_content = extract_text_content(json_file)
-            print(f"Extracted file content (first 500 chars): {file_content[:500]}")
+            extracted = ExtractedContent.build(file_path, context_dir, image_skip=image_skip)
         except Exception as e:
-            print(f"Error processing file {file_path}: {str(e)}")
-
-    # Process context directory
-    context_content = ""
-    if context_dir:
-        try:
-            context_json = context_directory(context_dir, image_skip=image_skip)
-            context_content = extract_text_content(context_json)
-            print(f"Extracted context content (first 500 chars): {context_content[:500]}")
-        except Exception as e:
-            print(f"Error processing context directory {context_dir}: {str(e)}")
+            print(f"Error processing input files: {str(e)}")
+            extracted = ExtractedContent()
+    file_content = extracted.file_text
+    context_content = extracted.context_text
+    print(f"Extracted file content (first 500 chars): {file_content[:500]}")
+    print(f"Extracted context content (first 500 chars): {context_content[:500]}")
 
     # Process images only if not skipping
     image_descriptions = []
     if not image_skip:
-        all_images = []
-        
-        # Collect images from file
-        if file_path:
-            img_dir = extract_image_directory_from_json(json_file)
-            if img_dir:
-                all_images.extend(list(img_dir.glob("*.png")))
-        
-        # Collect images from context
-        if context_dir:
-            for file_json in context_json.values():
-                img_dir = extract_image_directory_from_json(file_json)
-                if img_dir:
-                    all_images.extend(list(img_dir.glob("*.png")))
+        # Collect images from file and context
+        all_images = extracted.image_paths()
         
         # Add chat history images
         if chat_history_images:
@@ -77,76 +78,111 @@ def ollama_api(prompt: str, file_path: Optional[str] = None, context_dir: Option
         
         print(f"Total images to process: {len(all_images)}")
         
-        # Process images
-        for img_path in all_images:
-            try:
-                img_data = process_image(img_path)
-                if img_data:
-                    img_response = ollama.chat(model='minicpm-v:latest', messages=[
-                        {'role': 'user', 'content': "Describe this image in 50 words or less:", 'images': [img_data]}
-                    ])
-                    description = f"Image {getattr(img_path, 'name', 'chat history image')}:\n{img_response['message']['content']}"
-                    image_descriptions.append(description)
-                    print(description)
-                else:
-                    print(f"Skipping image {img_path} due to processing error")
-            except Exception as e:
-                error_msg = f"Error processing image {img_path}: {str(e)}"
+        def describe(img_path):
+            img_data = process_image(img_path)
+            if not img_data:
+                return None
+            img_response = client.chat(model=VISION_MODEL, messages=[
+                {'role': 'user', 'content': IMAGE_PROMPT, 'images': [img_data]}
+            ])
+            return img_response['message']['content']
+
+        def describe_batch(images, batch_prompt):
+            img_data = [process_image(img_path) for img_path in images]
+            if not all(img_data):
+                return None  # Falls back to one request per image
+            img_response = client.chat(model=VISION_MODEL, messages=[
+                {'role': 'user', 'content': batch_prompt, 'images': img_data}
+            ])
+            return img_response['message']['content']
+
+        # Process images, several per request; each image is only described once
+        results = describe_images(all_images, 'ollama', VISION_MODEL, describe, describe_batch)
+        for img_path, (summary, error) in zip(all_images, results):
+            if error:
+                error_msg = f"Error processing image {img_path}: {str(error)}"
                 print(error_msg)
                 image_descriptions.append(error_msg)
+            elif summary:
+                description = f"Image {image_label(img_path)}:\n{summary}"
+                image_descriptions.append(description)
+                print(description)
+            else:
+                print(f"Skipping image {img_path} due to processing error")
     
     # Combine image descriptions
     image_summaries = "\n\n".join(image_descriptions) if image_descriptions else ""
 
+    # History given as role/content messages is sent as chat messages, formatted text otherwise
+    history = history_messages if history_messages else chat_history
+
     # Combine all content
-    messages = [{'role': 'system', 'content': "You are a helpful assistant."}]
-    
-    # Add text content (context and file content)
-    text_content_parts = []
-    if context_content:
-        text_content_parts.append(f"Context: {context_content}")
-    if file_content:
-        text_content_parts.append(f"File content: {file_content}")
-    
-    if text_content_parts:
-        messages.append({'role': 'user', 'content': "\n\n".join(text_content_parts)})
-    
-    # Add image summaries
-    if image_summaries:
-        messages.append({'role': 'user', 'content': f"Image summaries:\n\n{image_summaries}"})
-    
-    # Process chat history
-    if chat_history:
-        try:
-            chat_history_messages = json.loads(chat_history)
-            if isinstance(chat_history_messages, list):
-                messages.extend(chat_history_messages)
-            else:
-                print("Chat history is not in the expected format. Skipping.")
-        except json.JSONDecodeError:
-            print("Failed to parse chat history as JSON. Adding as plain text.")
-            messages.append({'role': 'user', 'content': f"Chat history: {chat_history}"})
-    
-    # Add the user's prompt
-    messages.append({'role': 'user', 'content': f"User query: {prompt}"})
+    messages = PromptLayout(prompt, context_content, file_content, history, images=image_summaries).messages()
 
     print(f"Number of messages: {len(messages)}")
 
+    # num_ctx matches the window the prompt was budgeted for; otherwise the
+    # server truncates at its own default and drops the start of the prompt
+    options = {'num_predict': max_tokens, 'num_ctx': context_limit('ollama', model_name), **SAMPLING}
+
+    if session:
+        # Session mode: the chat endpoint gets the same leading messages every
+        # turn and the model stays loaded, so Ollama reuses the KV cache of that
+        # prefix and only evaluates the new messages
+        if stream:
+            def stream_chat():
+                try:
+                    for chunk in client.chat(model=full_model_name, messages=messages, options=options, keep_alive=KEEP_ALIVE, stream=True):
+                        if chunk['message']['content']:
+                            yield chunk['message']['content']
+                        if chunk.get('done'):
+                            report_prefill(chunk)
+                except Exception as e:
+                    error_msg = f"Error in Ollama API call: {str(e)}"
+                    print(error_msg)
+                    yield StreamError(error_msg)
+            return image_summaries, stream_chat()
+        try:
+            response = client.chat(model=full_model_name, messages=messages, options=options, keep_alive=KEEP_ALIVE)
+            report_prefill(response)
+            return image_summaries, response['message']['content']
+        except Exception as e:
+            error_msg = f"Error in Ollama API call: {str(e)}"
+            print(error_msg)
+            return "", error_msg
+
     # Flatten the prompt to utilize ollama's generate function
     flattened_prompt = "\n\n".join([f"{msg['role'].capitalize()}: {msg['content']}" for msg in messages])
 
     print(f"Flattened prompt length: {len(flattened_prompt)}")
 
+    if stream:
+        def stream_content():
+            try:
+                for chunk in client.generate(
+                    model=full_model_name,
+                    prompt=flattened_prompt,
+                    options=options,
+                    stream=True
+                ):
+                    if chunk['response']:
+                        yield chunk['response']
+                    if chunk.get('done'):
+                        report_prefill(chunk)
+            except Exception as e:
+                error_msg = f"Error in Ollama API call: {str(e)}"
+                print(error_msg)
+                yield StreamError(error_msg)
+        return image_summaries, stream_content()
+
     try:
-        response = generate(
+        response = client.generate(
             model=full_model_name,
             prompt=flattened_prompt,
-            options={
-                'num_predict': max_tokens,
-                'temperature': 0.4,  
-            }
+            options=options
         )
         content_summary = response['response']
+        report_prefill(response)
         print(f"Final response: {content_summary[:500]}...")  # Print first 500 chars of the response
         return image_summaries, content_summary
     except Exception as e:
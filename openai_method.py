@@ -1,16 +1,24 @@
 import os
-import base64
 import io
 import json
 import requests
-from openai import OpenAI
 from dotenv import load_dotenv
-from prep_file import combine_json, context_directory, extract_text_content
+from prep_file import ExtractedContent
+from clients import get_client
+from response_cache import StreamError
+from image_summary import describe_images, image_label
+from image_prep import prepare_image_base64
+from prompt_layout import PromptLayout
 from pathlib import Path
 
 load_dotenv()
 
-def gpt_api(prompt, file_path=None, context_dir=None, model_name='mini', max_tokens=500, chat_history=None, chat_history_images=None, image_skip=False):
+# Provider defaults are used; listed for the response cache key
+SAMPLING = {}
+
+IMAGE_SYSTEM_PROMPT = "You are a helpful assistant. Describe the following image in 50 words or less."
+
+def gpt_api(prompt, file_path=None, context_dir=None, model_name='mini', max_tokens=500, chat_history=None, chat_history_images=None, image_skip=False, extracted=None, stream=False):
     print(f"GPT API called with prompt: {prompt[:100]}...")
     print(f"File path: {file_path}")
     print(f"Context directory: {context_dir}")
@@ -29,7 +37,7 @@ def gpt_api(prompt, file_path=None, context_dir=None, model_name='mini', max_tok
     if not api_key:
         raise ValueError("OPENAI_API_KEY environment variable not set")
 
-    client = OpenAI(api_key=api_key)
+    client = get_client('openai')
 
     if full_model_name == 'dall-e-3':
         try:
@@ -45,94 +53,118 @@ def gpt_api(prompt, file_path=None, context_dir=None, model_name='mini', max_tok
             print(f"Error generating image: {e}")
             return "", f"Error generating image: {str(e)}"
 
-    json_file = {}
-    if file_path:
-        json_file = combine_json(file_path, image_skip=image_skip)
-
-    context_json = {}
-    if context_dir:
-        context_json = context_directory(context_dir, image_skip=image_skip)
-
-    text_content = extract_text_content(json_file) or ''
-    context_content = extract_text_content(context_json) or ''
+    # Reuse the request's extraction, only extracting here when called standalone
+    if extracted is None:
+        extracted = ExtractedContent.build(file_path, context_dir, image_skip=image_skip)
+    text_content = extracted.file_text
+    context_content = extracted.context_text
 
     image_summaries = []
     if not image_skip:
         # Process images and generate summaries
-        image_urls = []
-        def extract_image_urls(json_data):
-            urls = []
-            if isinstance(json_data, dict):
-                images = json_data.get('image_JSON', {}).get('images', [])
-                for image_info in images:
-                    image_url = image_info.get('url', '')
-                    if image_url:
-                        urls.append(image_url)
-            elif isinstance(json_data, dict):
-                for file_data in json_data.values():
-                    urls.extend(extract_image_urls(file_data))
-            return urls
-    
-        image_urls.extend(extract_image_urls(json_file))
-        image_urls.extend(extract_image_urls(context_json))
+        image_urls = extracted.image_urls()
         
         # Process chat history images
         if not image_skip and chat_history_images:
             image_urls.extend(chat_history_images)
     
-        for image_url in image_urls:
-            try:
-                image_content = None
-                if image_url.startswith('file://'):
-                    image_path = Path(image_url[7:])
-                    if image_path.exists():
-                        with open(image_path, "rb") as image_file:
-                            image_data = base64.b64encode(image_file.read()).decode('utf-8')
-                        image_content = {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/png;base64,{image_data}",
-                                "detail": "auto"
-                            }
-                        }
-                else:
+        def to_image_content(image_url):
+            image_content = None
+            if not isinstance(image_url, str):  # A PIL image from the chat history
+                image_data, mime_type = prepare_image_base64(image_url, 'openai')
+                image_content = {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:{mime_type};base64,{image_data}",
+                        "detail": "auto"
+                    }
+                }
+            elif image_url.startswith('file://'):
+                image_path = Path(image_url[7:])
+                if image_path.exists():
+                    # Downscaled and recompressed before upload
+                    image_data, mime_type = prepare_image_base64(image_path, 'openai')
                     image_content = {
                         "type": "image_url",
                         "image_url": {
-                            "url": image_url,
+                            "url": f"data:{mime_type};base64,{image_data}",
                             "detail": "auto"
                         }
                     }
-                
-                if image_content:
-                    image_summary_messages = [
-                        {"role": "system", "content": "You are a helpful assistant. Describe the following image in 50 words or less."},
-                        {"role": "user", "content": [image_content]}
-                    ]
-                    
-                    image_summary_response = client.chat.completions.create(
-                        model=full_model_name,
-                        messages=image_summary_messages,
-                        max_tokens=max_tokens
-                    )
-                    summary = image_summary_response.choices[0].message.content
-                    image_summaries.append(f"Image {Path(image_url).name}: {summary}")
-                    print(f"Successfully processed image: {image_url}")
-                else:
-                    print(f"Skipped image processing for: {image_url}")
-            except Exception as e:
-                print(f"Error processing image {image_url}: {str(e)}")
-                image_summaries.append(f"Error processing image {Path(image_url).name}: {str(e)}")
+            else:
+                image_content = {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": image_url,
+                        "detail": "auto"
+                    }
+                }
+            return image_content
+
+        def describe(image_url):
+            image_content = to_image_content(image_url)
+            if not image_content:
+                return None
+            image_summary_messages = [
+                {"role": "system", "content": IMAGE_SYSTEM_PROMPT},
+                {"role": "user", "content": [image_content]}
+            ]
+            image_summary_response = client.chat.completions.create(
+                model=full_model_name,
+                messages=image_summary_messages,
+                max_tokens=max_tokens
+            )
+            return image_summary_response.choices[0].message.content
+
+        def describe_batch(batch_urls, batch_prompt):
+            image_contents = [to_image_content(image_url) for image_url in batch_urls]
+            if not all(image_contents):
+                return None  # Falls back to one request per image
+            image_summary_messages = [
+                {"role": "system", "content": "You are a helpful assistant."},
+                {"role": "user", "content": [{"type": "text", "text": batch_prompt}, *image_contents]}
+            ]
+            image_summary_response = client.chat.completions.create(
+                model=full_model_name,
+                messages=image_summary_messages,
+                max_tokens=max_tokens
+            )
+            return image_summary_response.choices[0].message.content
+
+        # Several images go in each request and each image is only described once per model
+        results = describe_images(image_urls, 'openai', full_model_name, describe, describe_batch, prompt=IMAGE_SYSTEM_PROMPT)
+        for image_url, (summary, error) in zip(image_urls, results):
+            if error:
+                print(f"Error processing image {image_url}: {str(error)}")
+                image_summaries.append(f"Error processing image {image_label(image_url)}: {str(error)}")
+            elif summary:
+                image_summaries.append(f"Image {image_label(image_url)}: {summary}")
+                print(f"Successfully processed image: {image_url}")
+            else:
+                print(f"Skipped image processing for: {image_url}")
 
     # Generate content summary
-    content_summary_messages = [
-        {"role": "system", "content": "You are a helpful assistant."},
-        {"role": "user", "content": f"{context_content}\n\n{text_content}\n\n{prompt}"}
-    ]
+    content_summary_messages = PromptLayout(prompt, context_content, text_content, chat_history).messages()
 
-    # Add chat history to the content summary messages
-    if chat_history:
-        content_summary_messages.insert(1, {"role": "system", "content": f"Previous conversation: {chat_history}"})
+    if stream:
+        def stream_content():
+            try:
+                response = client.chat.completions.create(
+                    model=full_model_name,
+                    messages=content_summary_messages,
+                    max_tokens=max_tokens,
+                    stream=True
+                )
+                for chunk in response:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+            except Exception as e:
+                error_msg = f"Error generating content summary: {e}"
+                print(error_msg)
+                yield StreamError(error_msg)
+        if image_skip:
+            return "", stream_content()
+        return f"Image summaries:\n\n{' '.join(image_summaries)}\n\nContent summary:", stream_content()
 
     try:
         content_summary_response = client.chat.completions.create(
@@ -6,6 +6,12 @@ import os
 import glob
 import hashlib
 import zlib
+import re
+import time
+import shutil
+import queue
+import multiprocessing
+from collections import deque
 from pathlib import Path
 from urllib.parse import urlparse
 
@@ -20,6 +26,84 @@ def combine_json(file_path, image_skip=True):
         "image_JSON": image_JSON
     }
 
+EXTRACTION_WORKERS = int(os.environ.get("EXTRACTION_WORKERS", 0)) or os.cpu_count() or 1
+EXTRACTION_TIMEOUT = float(os.environ.get("EXTRACTION_TIMEOUT", 300))
+
+# Workers are spawned, not forked: extraction runs from the GUI worker and
+# watcher threads, and a forked child can inherit a lock another thread held
+_pool_context = multiprocessing.get_context("spawn")
+
+def _extract_file(file_path, image_skip):
+    return combine_json(file_path, image_skip=image_skip)
+
+def extract_files(file_paths, image_skip=True, max_workers=None, timeout=None):
+    """Extract files across a process pool, yielding (file_path, result, error) as each completes.
+
+    At most max_workers files are in flight, so each starts as soon as it is
+    submitted. A file running longer than timeout seconds is reported with a
+    TimeoutError; the pool is then restarted and the other in-flight files
+    are resubmitted.
+    """
+    file_paths = list(file_paths)
+    if not file_paths:
+        return
+    max_workers = max(1, min(max_workers or EXTRACTION_WORKERS, len(file_paths)))
+    timeout = timeout or EXTRACTION_TIMEOUT
+
+    # A single worker is not worth the pool start-up cost
+    if max_workers == 1:
+        for file_path in file_paths:
+            try:
+                yield file_path, _extract_file(file_path, image_skip), None
+            except Exception as e:
+                yield file_path, None, e
+        return
+
+    pending = deque(file_paths)
+    completed = queue.Queue()
+    running = {}
+    generation = 0
+    pool = _pool_context.Pool(max_workers)
+
+    def submit():
+        while pending and len(running) < max_workers:
+            file_path = pending.popleft()
+            running[file_path] = time.monotonic()
+            pool.apply_async(
+                _extract_file, (file_path, image_skip),
+                callback=lambda result, fp=file_path, gen=generation: completed.put((gen, fp, result, None)),
+                error_callback=lambda error, fp=file_path, gen=generation: completed.put((gen, fp, None, error))
+            )
+
+    try:
+        submit()
+        while running:
+            wait = min(running.values()) + timeout - time.monotonic()
+            try:
+                gen, file_path, result, error = completed.get(timeout=max(0, wait))
+            except queue.Empty:
+                # Kill the hung extraction(s) and resubmit everything else in flight
+                now = time.monotonic()
+                expired = [fp for fp, started in running.items() if now - started >= timeout]
+                pending.extendleft(fp for fp in running if fp not in expired)
+                running.clear()
+                pool.terminate()
+                pool.join()
+                generation += 1
+                pool = _pool_context.Pool(max_workers)
+                for file_path in expired:
+                    yield file_path, None, TimeoutError(f"Extraction timed out after {timeout}s")
+                submit()
+                continue
+            if gen != generation or file_path not in running:
+                continue
+            del running[file_path]
+            submit()
+            yield file_path, result, error
+    finally:
+        pool.terminate()
+        pool.join()
+
 def extract_text_content(json_file):
     if isinstance(json_file, dict):
         if 'text_JSON' in json_file:
@@ -39,75 +123,375 @@ def extract_text_content(json_file):
             return combined_text
     return ''
 
-def extract_image_directory_from_json(json_file):
-    images = json_file.get('image_JSON', {}).get('images', [])
-    image_urls = [image.get('url', '') for image in images]
-    
-    if not image_urls:
-        return None
-    
-    parsed_url = urlparse(image_urls[0])
-    image_path = Path(parsed_url.path.lstrip('/'))
-    return image_path.parent
+def image_paths_from_json(json_file):
+    # The file's image manifest lists exactly its own images in the shared store
+    paths = []
+    for image in json_file.get('image_JSON', {}).get('images', []):
+        if not image.get('url'):
+            continue
+        path = urlparse(image['url']).path
+        if re.match(r'^/+[A-Za-z]:', path):  # file:///C:/... on Windows
+            path = path.lstrip('/')
+        else:
+            path = '/' + path.lstrip('/')
+        paths.append(Path(path))
+    return paths
+
+class ExtractedContent:
+    """Extraction result for one request, built once and handed to the providers."""
+
+    def __init__(self, file_path=None, file_json=None, context_json=None, context_text=None):
+        self.file_path = file_path
+        self.file_json = file_json or {}
+        self.context_json = context_json or {}
+        self.file_text = extract_text_content(self.file_json) if self.file_json else ""
+        if context_text is None:
+            context_text = extract_text_content(self.context_json) if self.context_json else ""
+        self.context_text = context_text
+
+    @classmethod
+    def build(cls, file_path=None, context_dir=None, image_skip=True):
+        file_json = combine_json(file_path, image_skip=image_skip) if file_path else None
+        context_json = context_directory(context_dir, image_skip=image_skip, use_cache=True) if context_dir else None
+        return cls(file_path, file_json, context_json)
+
+    def for_file(self, file_path, file_json):
+        # Reuse the already extracted context for another file in the same batch
+        return ExtractedContent(file_path, file_json, self.context_json, self.context_text)
+
+    def with_text(self, file_text, context_text):
+        # Same files and images, with the text replaced (e.g. trimmed to a token budget)
+        extracted = ExtractedContent(self.file_path, None, self.context_json, context_text)
+        extracted.file_json = self.file_json
+        extracted.file_text = file_text
+        return extracted
+
+    def file_image_paths(self):
+        return list(dict.fromkeys(image_paths_from_json(self.file_json)))
+
+    def context_image_paths(self):
+        paths = []
+        for file_json in self.context_json.values():
+            paths.extend(image_paths_from_json(file_json))
+        return list(dict.fromkeys(paths))
+
+    def image_paths(self):
+        # Images are stored by content hash, so a duplicate image has the same path and is sent once
+        return list(dict.fromkeys(self.file_image_paths() + self.context_image_paths()))
+
+    def image_urls(self):
+        urls = []
+        for file_json in [self.file_json, *self.context_json.values()]:
+            for image_info in file_json.get('image_JSON', {}).get('images', []):
+                if image_info.get('url'):
+                    urls.append(image_info['url'])
+        return list(dict.fromkeys(urls))
+
+def file_hash(file_path):
+    hash_sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            hash_sha256.update(chunk)
+    return hash_sha256.hexdigest()
+
+DEFAULT_CACHE_ROOT = "context_cache"
+# Directories modified this recently are listed again on the next scan, as
+# coarse mtimes (network file systems) may hide a second change
+RECENT_MTIME_SECONDS = 2
+DEFAULT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+class ContextCacheRoot:
+    """Registry of the cached contexts under one root, evicted least recently used first."""
+
+    def __init__(self, root=DEFAULT_CACHE_ROOT, max_bytes=DEFAULT_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.registry_file = os.path.join(root, "contexts.json")
+
+    def _load_registry(self):
+        try:
+            with open(self.registry_file, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save_registry(self, registry):
+        os.makedirs(self.root, exist_ok=True)
+        temp_file = f"{self.registry_file}.tmp"
+        with open(temp_file, 'w') as f:
+            json.dump(registry, f)
+        os.replace(temp_file, self.registry_file)
+
+    @staticmethod
+    def context_key(context_dir, options):
+        key_data = json.dumps({"dir": os.path.abspath(context_dir), "options": options}, sort_keys=True)
+        return hashlib.sha1(key_data.encode()).hexdigest()[:16]
+
+    def context_path(self, key):
+        return os.path.join(self.root, key)
+
+    def touch(self, key, context_dir, options, size):
+        registry = self._load_registry()
+        registry[key] = {
+            "dir": os.path.abspath(context_dir),
+            "options": options,
+            "size": size,
+            "last_used": time.time()
+        }
+        self.evict(registry, keep=key)
+        self._save_registry(registry)
+
+    def evict(self, registry, keep=None):
+        total = sum(entry.get("size", 0) for entry in registry.values())
+        for key in sorted(registry, key=lambda k: registry[k].get("last_used", 0)):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= registry.pop(key).get("size", 0)
+            shutil.rmtree(self.context_path(key), ignore_errors=True)
+            print(f"Evicted cached context {key}")
 
 class ContextCache:
-    def __init__(self, context_dir, cache_file="context_cache.json"):
+    """Per-file store of extracted context, so a re-scan only re-extracts what changed.
+
+    Each file gets an index entry keyed by its path holding size, mtime and
+    (optionally) a content hash, plus a compressed blob with its extraction.
+    A manifest of directory listings lets a scan skip unchanged directories.
+    Caches live under a shared ContextCacheRoot, one per directory and set of
+    extraction options.
+    """
+
+    def __init__(self, context_dir, image_skip=True, cache_root=None, use_content_hash=False, watcher=None):
         self.context_dir = context_dir
-        self.cache_file = cache_file
+        self.options = {"image_skip": image_skip}
+        self.root = cache_root or ContextCacheRoot()
+        self.key = self.root.context_key(context_dir, self.options)
+        self.cache_dir = self.root.context_path(self.key)
+        self.use_content_hash = use_content_hash
+        self.index_file = os.path.join(self.cache_dir, "index.json")
+        self.index = self._load_index()
+        self.dirty = False
+        # Extractions already loaded by this instance, reused while their entry is valid
+        self.loaded = {}
+        self.manifest_file = os.path.join(self.cache_dir, "dirs.json")
+        self.manifest = self._load_manifest()
+        # Optional ContextWatcher; trusted once a scan has run while it was watching
+        self.watcher = watcher
+        self.watch_synced = False
+
+    def _load_index(self):
+        try:
+            with open(self.index_file, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def save_index(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        temp_file = f"{self.index_file}.tmp"
+        with open(temp_file, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(temp_file, self.index_file)
+        self.dirty = False
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_file, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {"dirs": {}}
 
-    def get_dir_hash(self):
-        hash_md5 = hashlib.md5()
+    def save_manifest(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        temp_file = f"{self.manifest_file}.tmp"
+        with open(temp_file, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(temp_file, self.manifest_file)
+
+    @staticmethod
+    def _list_dir(directory, mtime):
+        # Same view as os.walk: symlinked directories are not followed
+        files, subdirs = {}, []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            subdirs.append(entry.name)
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    continue
+                files[entry.name] = [st.st_size, st.st_mtime_ns]
+        if time.time() - mtime / 1e9 < RECENT_MTIME_SECONDS:
+            mtime = None
+        return {"mtime": mtime, "files": files, "subdirs": subdirs}
+
+    @staticmethod
+    def _stat_files(directory, listing):
+        # A file rewritten in place leaves its directory's mtime alone, so the
+        # listed files are still stat'ed; returns the listing and whether it changed
+        files = {}
+        for file_name, stat in listing["files"].items():
+            try:
+                st = os.stat(os.path.join(directory, file_name))
+            except OSError:
+                continue
+            files[file_name] = [st.st_size, st.st_mtime_ns]
+        if files == listing["files"]:
+            return listing, False
+        return {**listing, "files": files}, True
+
+    def _blob_path(self, file_path):
+        key = hashlib.sha1(os.path.abspath(file_path).encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"{key}.z")
+
+    def scan(self, full=False):
+        """Return {file_path: (size, mtime_ns)} for the files under the context directory.
+
+        A directory is only listed again when its mtime changed; the files of
+        the others are stat'ed from the manifest. With a running watcher not
+        even that: only the directories it reported are looked at. full=True
+        lists every directory again.
+        """
         if not isinstance(self.context_dir, (str, bytes, os.PathLike)):
             raise TypeError(f"Expected str, bytes or os.PathLike object, got {type(self.context_dir)}")
-        for root, _, files in os.walk(self.context_dir):
-            for file in files:
-                hash_md5.update(f"{file}{os.path.getmtime(os.path.join(root, file))}".encode())
-        return hash_md5.hexdigest()
+        watching = self.watcher is not None and self.watcher.running
+        changed_dirs = self.watcher.take_changes() if watching else set()
+        # Changes made before the watcher started can only be found by looking
+        trusted = watching and self.watch_synced and not full
+
+        old_dirs = self.manifest.get("dirs", {})
+        dirs = {}
+        stats = {}
+        changes = 0
+        pending = [self.context_dir]
+        while pending:
+            directory = pending.pop()
+            listing = None if full else old_dirs.get(directory)
+            changed = os.path.normpath(directory) in changed_dirs
+            if listing is None or changed or not trusted:
+                try:
+                    mtime = os.stat(directory).st_mtime_ns
+                except OSError:
+                    continue
+                if listing is None or changed or listing["mtime"] != mtime:
+                    try:
+                        listing = self._list_dir(directory, mtime)
+                    except OSError:
+                        continue
+                    changes += 1
+                else:
+                    listing, restated = self._stat_files(directory, listing)
+                    changes += restated
+            dirs[directory] = listing
+            for file_name, stat in listing["files"].items():
+                stats[os.path.join(directory, file_name)] = tuple(stat)
+            pending.extend(os.path.join(directory, name) for name in listing["subdirs"])
 
-    def is_cache_valid(self):
-        if not os.path.exists(self.cache_file):
+        if changes or dirs.keys() != old_dirs.keys():
+            self.manifest = {"dirs": dirs}
+            self.save_manifest()
+        self.watch_synced = watching
+        return stats
+
+    def is_entry_valid(self, file_path, stat):
+        entry = self.index.get(file_path)
+        if not entry or (file_path not in self.loaded and not os.path.exists(self._blob_path(file_path))):
             return False
-        with open(self.cache_file, 'r') as f:
-            cache = json.load(f)
-        return cache.get('dir_hash') == self.get_dir_hash()
-
-    def get_cached_context(self):
-        if self.is_cache_valid():
-            with open(self.cache_file, 'r') as f:
-                cache = json.load(f)
-                compressed_data = base64.b64decode(cache['context'])
-                return json.loads(zlib.decompress(compressed_data).decode())
-        return None
-
-    def save_cache(self, context):
-        compressed_data = zlib.compress(json.dumps(context).encode())
-        cache = {
-            'dir_hash': self.get_dir_hash(),
-            'context': base64.b64encode(compressed_data).decode()
+        if (entry['size'], entry['mtime']) == tuple(stat):
+            return True
+        # A touched but unchanged file keeps its entry when content hashing is on
+        if self.use_content_hash and entry.get('hash') and entry['size'] == stat[0]:
+            if file_hash(file_path) == entry['hash']:
+                entry['mtime'] = stat[1]
+                self.dirty = True
+                return True
+        return False
+
+    def load_entry(self, file_path):
+        if file_path in self.loaded:
+            return self.loaded[file_path]
+        with open(self._blob_path(file_path), 'rb') as f:
+            result = decompress_context(f.read())
+        # Stored images may have been garbage collected since the entry was saved
+        if not all(path.exists() for path in image_paths_from_json(result)):
+            raise FileNotFoundError(f"Images missing for cached entry of {file_path}")
+        self.loaded[file_path] = result
+        return result
+
+    def save_entry(self, file_path, stat, result):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        blob = compress_context(result)
+        with open(self._blob_path(file_path), 'wb') as f:
+            f.write(blob)
+        self.index[file_path] = {
+            'size': stat[0],
+            'mtime': stat[1],
+            'bytes': len(blob),
+            'hash': file_hash(file_path) if self.use_content_hash else None
         }
-        with open(self.cache_file, 'w') as f:
-            json.dump(cache, f)
+        self.loaded[file_path] = result
+        self.dirty = True
 
-def context_directory(directory_path, image_skip=True, use_cache=True):
-    if use_cache:
-        cache = ContextCache(directory_path)
-        cached_context = cache.get_cached_context()
-        if cached_context:
-            return cached_context
+    def drop_entry(self, file_path):
+        self.index.pop(file_path, None)
+        self.loaded.pop(file_path, None)
+        self.dirty = True
+        try:
+            os.remove(self._blob_path(file_path))
+        except FileNotFoundError:
+            pass
 
-    combined_results = {}
-    for root, _, files in os.walk(directory_path):
-        for file_name in files:
-            file_path = os.path.join(root, file_name)
-            try:
-                result = combine_json(file_path, image_skip=image_skip)
-                combined_results[file_path] = result
-            except Exception as e:
-                print(f"Error processing file {file_path}: {str(e)}")
+    def size(self):
+        return sum(entry.get('bytes', 0) for entry in self.index.values())
 
+    def _mark_used(self):
+        self.root.touch(self.key, self.context_dir, self.options, self.size())
+
+    def refresh(self, max_workers=None, timeout=None, full=False):
+        stats = self.scan(full)
+        context = {}
+        stale = []
+
+        # Drop entries for deleted files
+        for file_path in set(self.index) - set(stats):
+            self.drop_entry(file_path)
+
+        for file_path, stat in stats.items():
+            if self.is_entry_valid(file_path, stat):
+                try:
+                    context[file_path] = self.load_entry(file_path)
+                    continue
+                except (OSError, zlib.error, ValueError):
+                    pass
+            stale.append(file_path)
+
+        # Only new or changed files are extracted, in parallel
+        for file_path, result, error in extract_files(stale, self.options["image_skip"], max_workers, timeout):
+            if error:
+                print(f"Error processing file {file_path}: {str(error)}")
+                continue
+            self.save_entry(file_path, stats[file_path], result)
+            context[file_path] = result
+
+        if self.dirty or not os.path.exists(self.index_file):
+            self.save_index()
+        self._mark_used()
+        return context
+
+def context_directory(directory_path, image_skip=True, use_cache=True, max_workers=None, timeout=None, use_content_hash=False):
     if use_cache:
-        cache.save_cache(combined_results)
+        return ContextCache(directory_path, image_skip=image_skip, use_content_hash=use_content_hash).refresh(max_workers, timeout)
 
+    file_paths = [os.path.join(root, file_name) for root, _, files in os.walk(directory_path) for file_name in files]
+    combined_results = {}
+    for file_path, result, error in extract_files(file_paths, image_skip, max_workers, timeout):
+        if error:
+            print(f"Error processing file {file_path}: {str(error)}")
+            continue
+        combined_results[file_path] = result
     return combined_results
 
 def compress_context(context_json):
@@ -0,0 +1,67 @@
+import os
+import time
+import hashlib
+import threading
+
+# Opt-in: put the context directory text in a provider-cached prefix
+# (Anthropic prompt caching, Gemini cached contents)
+PROMPT_CACHING = os.environ.get("PROMPT_CACHING", "").lower() in ("1", "true", "yes")
+CACHING_PROVIDERS = ['anthropic', 'google']
+
+ANTHROPIC_CACHE_TTL = 300  # Refreshed by every call that reads it
+GEMINI_CACHE_TTL = int(os.environ.get("GEMINI_CACHE_TTL", 3600))
+EXPIRY_MARGIN = 30  # Treat a cache as gone slightly before the provider drops it
+
+def caching_enabled(dev):
+    return PROMPT_CACHING and dev in CACHING_PROVIDERS
+
+def context_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+class PromptCacheRegistry:
+    """Provider cache handles and their expiry per (provider, model, context hash).
+
+    Also keeps the hit/miss status of the last call made from each thread.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def get(self, provider, model, key):
+        with self._lock:
+            entry = self._entries.get((provider, model, key))
+            if entry and entry["expires"] - EXPIRY_MARGIN > time.time():
+                return entry["handle"]
+            self._entries.pop((provider, model, key), None)
+            return None
+
+    def put(self, provider, model, key, handle, ttl):
+        with self._lock:
+            self._entries[(provider, model, key)] = {"handle": handle, "expires": time.time() + ttl}
+
+    def report(self, provider, model, hit, cached_tokens=0, written_tokens=0):
+        status = f"prompt cache {'hit' if hit else 'miss'}"
+        if cached_tokens:
+            status += f", {cached_tokens:,} tokens read from cache"
+        if written_tokens:
+            status += f", {written_tokens:,} tokens written to cache"
+        print(f"{provider} {model}: {status}")
+        self._local.status = status
+
+    def clear_status(self):
+        self._local.status = None
+
+    def last_status(self):
+        return getattr(self._local, 'status', None)
+
+prompt_caches = PromptCacheRegistry()
+
+def report_anthropic_usage(model, key, usage):
+    # Anthropic reports what was read from and written to its cache
+    read = getattr(usage, 'cache_read_input_tokens', 0) or 0
+    written = getattr(usage, 'cache_creation_input_tokens', 0) or 0
+    if read or written:
+        prompt_caches.put('anthropic', model, key, None, ANTHROPIC_CACHE_TTL)
+    prompt_caches.report('anthropic', model, bool(read), read, written)
@@ -0,0 +1,93 @@
+import os
+import threading
+from history_summary import format_messages
+
+SYSTEM_PROMPT = "You are a helpful assistant."
+
+# Every provider sends the sections in this order, from the most static to the
+# most dynamic, so the provider prompt caches and Ollama's KV cache can reuse
+# the longest possible prefix of the previous call
+SECTION_LABELS = {
+    'context': "Context",
+    'file': "File",
+    'images': "Image summaries",
+    'history': "Previous conversation",
+    'question': "User",
+}
+
+class PromptLayout:
+    """The parts of one prompt: system, context, file, image summaries, history and question.
+
+    history is formatted text, or a list of role/content messages for the
+    providers that send it as chat messages.
+    """
+
+    def __init__(self, question, context="", file="", history=None, images="", system=SYSTEM_PROMPT):
+        self.question = question or ""
+        self.context = context or ""
+        self.file = file or ""
+        self.history = history or ""
+        self.images = images or ""
+        self.system = system
+
+    def history_text(self):
+        return format_messages(self.history) if isinstance(self.history, list) else self.history
+
+    def sections(self, skip=()):
+        texts = {
+            'context': self.context,
+            'file': self.file,
+            'images': self.images,
+            'history': self.history_text(),
+            'question': self.question,
+        }
+        return [(name, text) for name, text in texts.items() if name not in skip and text.strip()]
+
+    def text(self, skip=(), system=False):
+        # system=True puts the system prompt first, for providers without a system role
+        parts = [self.system] if system and self.system else []
+        parts.extend(f"{SECTION_LABELS[name]}: {text}" for name, text in self.sections(skip))
+        return "\n\n".join(parts)
+
+    def messages(self, skip=()):
+        """Chat messages: the system prompt, then the sections in one user message.
+
+        A history given as messages is sent as those messages, between the
+        sections before it and the question.
+        """
+        messages = [{"role": "system", "content": self.system}] if self.system else []
+        if not isinstance(self.history, list):
+            messages.append({"role": "user", "content": self.text(skip)})
+            return messages
+        static = self.text(set(skip) | {'history', 'question'})
+        if static:
+            messages.append({"role": "user", "content": static})
+        messages.extend({"role": msg["role"].lower(), "content": msg["content"]} for msg in self.history)
+        messages.append({"role": "user", "content": self.text(set(SECTION_LABELS) - {'question'})})
+        return messages
+
+class PrefixTracker:
+    """Measures how much of each prompt starts the same way as the previous one sent to that model.
+
+    Only a matching prefix can be served from a provider's prompt cache or
+    Ollama's KV cache, so a low match means the layout is defeating them.
+    """
+
+    def __init__(self):
+        self._last = {}
+        self._lock = threading.Lock()
+
+    def record(self, provider, model, text):
+        # Returns None for the first prompt to a model
+        with self._lock:
+            previous = self._last.get((provider, model))
+            self._last[(provider, model)] = text
+        if previous is None:
+            return None
+        return {"matched": len(os.path.commonprefix([previous, text])), "length": len(text)}
+
+prompt_prefixes = PrefixTracker()
+
+def format_prefix_match(match):
+    share = match["matched"] / match["length"] if match["length"] else 0
+    return f"{share:.0%} of the prompt ({match['matched']:,} of {match['length']:,} chars) matches the previous one"
@@ -4,24 +4,172 @@ import base64
 import json
 import logging
 import tempfile
-import shutil
+import hashlib
+import threading
+import time
+from collections import Counter
 from PIL import Image
-import fitz  # PyMuPDF
-from docx import Document
-from pptx import Presentation
-import openpyxl
-from bs4 import BeautifulSoup
-import requests
 
-# Define the path for the temporary directory
-temp_dir = os.path.join(tempfile.gettempdir(), "my_temp_dir")
+# The document parsers (fitz, docx, pptx, openpyxl, bs4) and requests are
+# imported in the branch that needs them, so importing this module stays cheap
 
-# Refresh the temporary directory at the start of the application
-if os.path.exists(temp_dir):
-    shutil.rmtree(temp_dir)
-os.makedirs(temp_dir)
+# Define the path for the image directory; it is kept between sessions and
+# trimmed by collect_garbage() instead of being wiped at startup
+default_temp_dir = os.path.join(tempfile.gettempdir(), "my_temp_dir")
+# Absolute, as the stored images are referred to by file:// URLs
+temp_dir = os.path.abspath(os.environ.get("IMAGE_STORE_DIR") or default_temp_dir)
+os.makedirs(temp_dir, exist_ok=True)
+
+# Images are stored once under the hash of their bytes; each source file gets a
+# manifest listing its own images so nothing has to scan the shared directory
+image_store_dir = os.path.join(temp_dir, "images")
+manifest_dir = os.path.join(temp_dir, "manifests")
+
+IMAGE_STORE_MAX_BYTES = int(os.environ.get("IMAGE_STORE_MAX_MB", 1024)) * 1024 * 1024
+IMAGE_STORE_MAX_AGE = int(os.environ.get("IMAGE_STORE_MAX_AGE_DAYS", 30)) * 24 * 3600
+# Files written this recently are never collected, as an extraction may still be using them
+GC_GRACE_SECONDS = 3600
+
+_gc_thread = None
+
+def manifest_path(file_path):
+    name = hashlib.sha1(os.path.abspath(file_path).encode()).hexdigest()
+    return os.path.join(manifest_dir, f"{name}.json")
+
+def load_manifest(file_path):
+    # The stored result is reused while the file is unchanged and its images still exist
+    try:
+        with open(manifest_path(file_path), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        stat = os.stat(file_path)
+    except (OSError, json.JSONDecodeError):
+        return None
+    if manifest.get("file_size") != stat.st_size or manifest.get("mtime") != stat.st_mtime:
+        return None
+    result = manifest.get("result", {})
+    for image in result.get("images", []):
+        if not os.path.exists(os.path.join(image_store_dir, f"{image.get('sha256')}.png")):
+            return None
+    # The manifest mtime is the file's last-used time for garbage collection
+    try:
+        os.utime(manifest_path(file_path))
+    except OSError:
+        pass
+    return result
+
+def save_manifest(file_path, result):
+    os.makedirs(manifest_dir, exist_ok=True)
+    stat = os.stat(file_path)
+    manifest = {"file_path": os.path.abspath(file_path), "file_size": stat.st_size, "mtime": stat.st_mtime, "result": result}
+    path = manifest_path(file_path)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(temp_path, path)
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def collect_garbage(max_bytes=None, max_age=None):
+    """Trim the image directory; returns the number of images and bytes removed.
+
+    Manifests unused for max_age seconds are dropped, then the least recently
+    used ones until the stored images fit in max_bytes. Images no manifest
+    refers to any more are deleted.
+    """
+    max_bytes = IMAGE_STORE_MAX_BYTES if max_bytes is None else max_bytes
+    max_age = IMAGE_STORE_MAX_AGE if max_age is None else max_age
+    now = time.time()
+
+    # Images from the old flat layout are not referenced by anything; only
+    # the default directory had that layout, a chosen one may hold other files
+    if temp_dir == os.path.abspath(default_temp_dir):
+        for entry in os.scandir(temp_dir):
+            if entry.is_file() and entry.name.endswith(".png") and now - entry.stat().st_mtime > GC_GRACE_SECONDS:
+                _remove(entry.path)
+
+    manifests = []
+    references = Counter()
+    if os.path.isdir(manifest_dir):
+        for entry in os.scandir(manifest_dir):
+            if not entry.name.endswith(".json"):
+                continue
+            mtime = entry.stat().st_mtime
+            if now - mtime > max_age:
+                _remove(entry.path)
+                continue
+            try:
+                with open(entry.path, 'r', encoding='utf-8') as f:
+                    images = json.load(f).get("result", {}).get("images", [])
+            except (OSError, json.JSONDecodeError):
+                _remove(entry.path)
+                continue
+            hashes = {image.get("sha256") for image in images}
+            manifests.append((mtime, entry.path, hashes))
+            references.update(hashes)
+
+    blobs = {}
+    if os.path.isdir(image_store_dir):
+        for entry in os.scandir(image_store_dir):
+            if entry.name.endswith(".png"):
+                stat = entry.stat()
+                blobs[entry.name[:-4]] = (entry.path, stat.st_size, stat.st_mtime)
+    removed_images, removed_bytes = 0, 0
+
+    def remove_blob(image_hash):
+        nonlocal removed_images, removed_bytes
+        path, size, mtime = blobs[image_hash]
+        if now - mtime <= GC_GRACE_SECONDS:
+            return
+        _remove(path)
+        del blobs[image_hash]
+        removed_images += 1
+        removed_bytes += size
+
+    for image_hash in [h for h in blobs if not references[h]]:
+        remove_blob(image_hash)
+
+    total = sum(size for _, size, _ in blobs.values())
+    manifests.sort()  # Least recently used first
+    for mtime, path, hashes in manifests:
+        if total <= max_bytes or now - mtime <= GC_GRACE_SECONDS:
+            break
+        _remove(path)
+        references.subtract(hashes)
+        for image_hash in hashes:
+            if image_hash in blobs and not references[image_hash]:
+                size = blobs[image_hash][1]
+                remove_blob(image_hash)
+                if image_hash not in blobs:
+                    total -= size
+    return removed_images, removed_bytes
+
+def start_garbage_collection():
+    # Runs once per session on a daemon thread so it never delays startup or exit
+    global _gc_thread
+    if _gc_thread is not None:
+        return _gc_thread
+
+    def run():
+        try:
+            removed_images, removed_bytes = collect_garbage()
+            if removed_images:
+                logging.info(f"Removed {removed_images} stored images ({removed_bytes / 1024 / 1024:.1f} MB)")
+        except OSError as e:
+            logging.error(f"Error cleaning up stored images: {str(e)}")
+
+    _gc_thread = threading.Thread(target=run, daemon=True)
+    _gc_thread.start()
+    return _gc_thread
 
 def extract_images(file_path):
+    manifest = load_manifest(file_path)
+    if manifest is not None:
+        return manifest
+
     _, ext = os.path.splitext(file_path)
     ext = ext.lower()
 
@@ -35,15 +183,23 @@ def extract_images(file_path):
         "images": []
     }
 
-    def save_image(image, image_name):
-        image_path = os.path.join(temp_dir, f"{image_name}.png")
-        image.save(image_path, format='PNG')
+    def save_image(image, image_hash):
+        # An image already in the store, from this or any other file, is not written again
+        image_path = os.path.join(image_store_dir, f"{image_hash}.png")
+        if os.path.exists(image_path):
+            os.utime(image_path)  # Marks it in use until this file's manifest is saved
+        else:
+            os.makedirs(image_store_dir, exist_ok=True)
+            temp_path = f"{image_path}.{os.getpid()}.tmp"
+            image.save(temp_path, format='PNG')
+            os.replace(temp_path, image_path)
         return image_path
 
     def process_image_data(image_data, image_name, image_format):
         try:
             image = Image.open(io.BytesIO(image_data))
-            image_path = save_image(image, image_name)
+            image_hash = hashlib.sha256(image_data).hexdigest()
+            image_path = save_image(image, image_hash)
             # Correctly format the URL for Windows
             image_url = image_path.replace("\\", "/")
             result["images"].append({
@@ -52,6 +208,7 @@ def extract_images(file_path):
                 "image_type": image_format.lower(),
                 "image_width": image.width,
                 "image_height": image.height,
+                "sha256": image_hash,
                 "url": f"file:///{image_url}"  # URL to access the image
             })
             logging.info(f"Processed image: {image_name}")
@@ -62,7 +219,9 @@ def extract_images(file_path):
         if ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp']:
             with Image.open(file_path) as img:
                 image_name = os.path.splitext(os.path.basename(file_path))[0]
-                image_path = save_image(img, image_name)
+                with open(file_path, 'rb') as f:
+                    image_hash = hashlib.sha256(f.read()).hexdigest()
+                image_path = save_image(img, image_hash)
                 image_url = image_path.replace("\\", "/")
                 result["images"].append({
                     "image_name": image_name,
@@ -70,11 +229,13 @@ def extract_images(file_path):
                     "image_type": ext,
                     "image_width": img.width,
                     "image_height": img.height,
+                    "sha256": image_hash,
                     "url": f"file:///{image_url}"  # URL to access the image
                 })
                 logging.info(f"Processed image file: {file_path}")
 
         elif ext == '.pdf':
+            import fitz  # PyMuPDF
             doc = fitz.open(file_path)
             for page_num, page in enumerate(doc):
                 for img_index, img in enumerate(page.get_images(full=True)):
@@ -86,6 +247,7 @@ def extract_images(file_path):
                     process_image_data(image_bytes, image_name, image_ext)
 
         elif ext in ['.docx', '.doc']:
+            from docx import Document
             doc = Document(file_path)
             for rel in doc.part.rels.values():
                 if "image" in rel.target_ref:
@@ -94,6 +256,7 @@ def extract_images(file_path):
                     process_image_data(image_data, image_name, image_name.split('.')[-1])
 
         elif ext in ['.pptx', '.ppt']:
+            from pptx import Presentation
             prs = Presentation(file_path)
             for slide_num, slide in enumerate(prs.slides):
                 for shape in slide.shapes:
@@ -103,6 +266,7 @@ def extract_images(file_path):
                         process_image_data(image_data, image_name, shape.image.ext)
 
         elif ext in ['.xlsx', '.xls']:
+            import openpyxl
             wb = openpyxl.load_workbook(file_path, read_only=True)
             for sheet in wb.worksheets:
                 for image in sheet._images:
@@ -111,6 +275,8 @@ def extract_images(file_path):
                     process_image_data(image_data, image_name, image.format)
 
         elif ext == '.html':
+            from bs4 import BeautifulSoup
+            import requests
             with open(file_path, 'r', encoding='utf-8') as file:
                 soup = BeautifulSoup(file, 'html.parser')
                 for img_tag in soup.find_all('img'):
@@ -133,6 +299,8 @@ def extract_images(file_path):
         logging.error(f"Error processing file {file_path}: {str(e)}")
         result["metadata"]["error"] = f"Error processing file: {str(e)}"
 
+    if "error" not in result["metadata"]:
+        save_manifest(file_path, result)
     return result
 
 
@@ -2,16 +2,19 @@ import os
 import io
 import re
 from PIL import Image
-import pytesseract
-import fitz
-from docx import Document
-from pptx import Presentation
 import csv
-import openpyxl
 import hashlib
 
-def extract_json_text(file_path):
+# The document parsers (pytesseract, fitz, docx, pptx, openpyxl) are imported
+# in the branch that needs them, so importing this module stays cheap
+
+# Rows in tabular files are short and rarely contain each other, so only exact
+# duplicates are removed there unless check_similar is set explicitly
+TABULAR_EXTENSIONS = ['.csv', '.xlsx', '.xls']
+
+def extract_json_text(file_path, check_similar=None):
     def apply_ocr(image):
+        import pytesseract
         try:
             return pytesseract.image_to_string(image)
         except pytesseract.TesseractNotFoundError:
@@ -20,20 +23,49 @@ def extract_json_text(file_path):
     def hash_content(content):
         return hashlib.md5(content.encode('utf-8')).hexdigest()[:8]  # Shortened hash
 
-    def add_content(content, check_similar=True):
+    def find_containing(content):
+        # Only blocks sharing every interior word can contain this one; the
+        # outer words may be cut mid-word, so they are not used as filters
+        words = content.split()
+        words = set(words[1:-1] if len(words) > 2 else words)
+        candidates = None
+        for word in sorted(words, key=lambda w: len(word_index.get(w, ()))):
+            postings = word_index.get(word)
+            if not postings:
+                return None
+            candidates = set(postings) if candidates is None else candidates & postings
+            if not candidates:
+                return None
+        for existing_hash in candidates or ():
+            if content in unique_contents[existing_hash]:
+                return existing_hash
+        return None
+
+    def add_content(content, check_similar=None):
         if len(content.strip()) < 5:
             return None
-            
-        content_hash = hash_content(content)
-        
-        # Check for similar existing content
+        if check_similar is None:
+            check_similar = dedup_similar
+        stripped = content.strip()
+
+        # Exact duplicates are a single lookup
+        existing_hash = exact_index.get(stripped)
+        if existing_hash:
+            return existing_hash
+
+        # Check for an existing block that already contains this one
         if check_similar:
-            for existing_hash, existing_content in unique_contents.items():
-                if content.strip() in existing_content or existing_content in content.strip():
-                    return existing_hash
-                    
+            existing_hash = find_containing(stripped)
+            if existing_hash:
+                return existing_hash
+
+        content_hash = hash_content(content)
         if content_hash not in unique_contents:
             unique_contents[content_hash] = content
+            exact_index[stripped] = content_hash
+            if check_similar:
+                for word in set(stripped.split()):
+                    word_index.setdefault(word, set()).add(content_hash)
         return content_hash
 
     # Simplified metadata structure
@@ -47,9 +79,13 @@ def extract_json_text(file_path):
     }
 
     unique_contents = {}
+    exact_index = {}
+    word_index = {}
+
+    ext = os.path.splitext(file_path)[1].lower()
+    dedup_similar = check_similar if check_similar is not None else ext not in TABULAR_EXTENSIONS
 
     try:
-        ext = os.path.splitext(file_path)[1].lower()
         if ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp']:
             image = Image.open(file_path)
             ocr_text = apply_ocr(image)
@@ -59,6 +95,7 @@ def extract_json_text(file_path):
                     result["content"]["pages"].append({"n": 1, "h": [content_hash]})
 
         elif ext == '.pdf':
+            import fitz
             doc = fitz.open(file_path)
             for page_num, page in enumerate(doc, start=1):
                 # Get blocks of text to preserve layout structure
@@ -95,6 +132,7 @@ def extract_json_text(file_path):
             doc.close()
 
         elif ext in ['.docx', '.doc']:
+            from docx import Document
             doc = Document(file_path)
             current_page = []
             page_num = 1
@@ -124,6 +162,7 @@ def extract_json_text(file_path):
                 })
 
         elif ext in ['.pptx', '.ppt']:
+            from pptx import Presentation
             prs = Presentation(file_path)
             for slide_num, slide in enumerate(prs.slides, start=1):
                 slide_content = []
@@ -136,6 +175,7 @@ def extract_json_text(file_path):
                     result["content"]["pages"].append({"n": slide_num, "h": slide_content})
 
         elif ext in ['.xlsx', '.xls']:
+            import openpyxl
             wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
             for sheet in wb.worksheets:
                 sheet_content = []
@@ -0,0 +1,99 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+
+DEFAULT_RESPONSE_TTL = 7 * 24 * 3600
+DEFAULT_RESPONSE_MAX_BYTES = 100 * 1024 * 1024
+
+def directory_size(directory, suffix):
+    return sum(entry.stat().st_size for entry in os.scandir(directory) if entry.name.endswith(suffix))
+
+def evict_least_recent(directory, max_bytes, suffix):
+    """Remove the least recently used files ending in suffix until they fit max_bytes.
+
+    The file mtime is the last-used time. Trims to 90% of the cap so eviction
+    does not run on every write; returns the remaining total size.
+    """
+    entries = [entry for entry in os.scandir(directory) if entry.name.endswith(suffix)]
+    entries.sort(key=lambda entry: entry.stat().st_mtime)
+    total = sum(entry.stat().st_size for entry in entries)
+    for entry in entries:
+        if total <= max_bytes * 0.9:
+            break
+        total -= entry.stat().st_size
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+    return total
+
+class StreamError(str):
+    """Error text a provider stream yields when it fails part way; a stream containing one is never cached."""
+
+class ResponseCache:
+    """On-disk cache of model responses, one JSON file per request key.
+
+    Entries expire after ttl seconds; once the cache grows past max_bytes the
+    least recently used entries are removed.
+    """
+
+    def __init__(self, cache_dir="response_cache", ttl=DEFAULT_RESPONSE_TTL, max_bytes=DEFAULT_RESPONSE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._total = None
+
+    @staticmethod
+    def make_key(**parts):
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if time.time() - entry.get("created", 0) > self.ttl:
+            self._remove(path)
+            return None
+        # The file mtime doubles as the last-used time for eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry["value"]
+
+    def put(self, key, value):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        data = json.dumps({"created": time.time(), "value": value}, ensure_ascii=False).encode('utf-8')
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, self._path(key))
+        with self._lock:
+            if self._total is None:
+                self._total = directory_size(self.cache_dir, ".json")
+            else:
+                self._total += len(data)
+            if self._total > self.max_bytes:
+                self._total = evict_least_recent(self.cache_dir, self.max_bytes, ".json")
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        if os.path.isdir(self.cache_dir):
+            for entry in os.scandir(self.cache_dir):
+                self._remove(entry.path)
+        self._total = 0
@@ -0,0 +1,133 @@
+import os
+import re
+import math
+import hashlib
+import zlib
+from collections import Counter, defaultdict
+from prep_file import ContextCacheRoot, extract_text_content, compress_context, decompress_context
+from token_budget import estimate_tokens
+
+# Chunks are windows of words that overlap so a passage is never cut off from
+# its surroundings. Override the retrieval defaults with RETRIEVAL_TOP_K and
+# RETRIEVAL_TOKEN_BUDGET in the .env file.
+CHUNK_WORDS = 200
+CHUNK_OVERLAP = 40
+RETRIEVAL_TOP_K = int(os.environ.get("RETRIEVAL_TOP_K", 8))
+RETRIEVAL_TOKEN_BUDGET = int(os.environ.get("RETRIEVAL_TOKEN_BUDGET", 4000))
+
+# BM25 parameters
+K1 = 1.5
+B = 0.75
+
+def tokenize(text):
+    return re.findall(r'\w+', text.lower())
+
+def chunk_text(text, chunk_words=CHUNK_WORDS, overlap=CHUNK_OVERLAP):
+    words = text.split()
+    if not words:
+        return []
+    step = max(1, chunk_words - overlap)
+    chunks = []
+    for start in range(0, len(words), step):
+        chunks.append(" ".join(words[start:start + chunk_words]))
+        if start + chunk_words >= len(words):
+            break
+    return chunks
+
+class ContextIndex:
+    """BM25 index over the chunks of a context directory.
+
+    It is stored as bm25.z in the directory's ContextCache folder and updated
+    per file: only files whose extracted text changed are re-chunked.
+    """
+
+    def __init__(self, context_dir, image_skip=True):
+        self.context_dir = context_dir
+        root = ContextCacheRoot()
+        cache_dir = root.context_path(root.context_key(context_dir, {"image_skip": image_skip}))
+        self.index_file = os.path.join(cache_dir, "bm25.z")
+        self.files = self._load()
+        self.chunks = []
+        self.postings = None
+
+    def _load(self):
+        try:
+            with open(self.index_file, 'rb') as f:
+                return decompress_context(f.read()).get("files", {})
+        except (FileNotFoundError, zlib.error, ValueError):
+            return {}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.index_file), exist_ok=True)
+        temp_file = f"{self.index_file}.tmp"
+        with open(temp_file, 'wb') as f:
+            f.write(compress_context({"files": self.files}))
+        os.replace(temp_file, self.index_file)
+
+    def update(self, context_json):
+        changed = False
+        for file_path in set(self.files) - set(context_json):
+            del self.files[file_path]
+            changed = True
+        for file_path, file_json in context_json.items():
+            text = extract_text_content(file_json) if isinstance(file_json, dict) else ""
+            signature = hashlib.sha1(text.encode('utf-8')).hexdigest()
+            if self.files.get(file_path, {}).get("sig") == signature:
+                continue
+            chunks = chunk_text(text)
+            self.files[file_path] = {
+                "sig": signature,
+                "chunks": chunks,
+                "tfs": [dict(Counter(tokenize(chunk))) for chunk in chunks]
+            }
+            changed = True
+        if changed or self.postings is None:
+            self._build_postings()
+        if changed:
+            self.save()
+        return self
+
+    def _build_postings(self):
+        self.chunks = []
+        self.lengths = []
+        self.postings = defaultdict(list)
+        for file_path in sorted(self.files):
+            entry = self.files[file_path]
+            for position, (chunk, tf) in enumerate(zip(entry["chunks"], entry["tfs"])):
+                chunk_id = len(self.chunks)
+                self.chunks.append((file_path, position, chunk))
+                self.lengths.append(sum(tf.values()))
+                for term, count in tf.items():
+                    self.postings[term].append((chunk_id, count))
+        self.avg_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0
+
+    def search(self, query, top_k=RETRIEVAL_TOP_K, token_budget=RETRIEVAL_TOKEN_BUDGET):
+        """Return up to top_k (file_path, position, chunk) of the best-scoring chunks that fit in token_budget."""
+        if not self.chunks:
+            return []
+        scores = defaultdict(float)
+        total = len(self.chunks)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+            for chunk_id, count in postings:
+                norm = K1 * (1 - B + B * self.lengths[chunk_id] / self.avg_length)
+                scores[chunk_id] += idf * count * (K1 + 1) / (count + norm)
+
+        selected = []
+        used = 0
+        for chunk_id in sorted(scores, key=scores.get, reverse=True):
+            if len(selected) >= top_k:
+                break
+            tokens = estimate_tokens(self.chunks[chunk_id][2])
+            if used + tokens > token_budget:
+                continue  # A shorter, lower-ranked chunk may still fit
+            selected.append(chunk_id)
+            used += tokens
+        # Keep document order so neighbouring chunks read naturally
+        return [self.chunks[chunk_id] for chunk_id in sorted(selected)]
+
+def format_chunks(chunks):
+    return "\n\n".join(f"[{os.path.basename(file_path)} #{position + 1}]\n{chunk}" for file_path, position, chunk in chunks)
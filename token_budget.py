@@ -0,0 +1,145 @@
+import os
+import math
+import threading
+from prompt_layout import format_prefix_match
+
+# Context window per model, falling back to the provider default.
+# Override with e.g. OLLAMA_CONTEXT_TOKENS=32768 in the .env file.
+MODEL_CONTEXT_TOKENS = {
+    'gpt-4o': 128000,
+    'gpt-4o-mini': 128000,
+    'o1-preview': 128000,
+    'gemini-1.5-flash': 1048576,
+    'gemini-1.5-flash-002': 1048576,
+    'gemini-1.5-pro': 2097152,
+    'gemini-1.5-pro-002': 2097152,
+    'ministral-8b-latest': 128000,
+    'ministral-3b-latest': 128000,
+    'open-mistral-nemo': 128000,
+    'mistral-large-latest': 128000,
+    'codestral-latest': 32000,
+}
+PROVIDER_CONTEXT_TOKENS = {
+    'openai': 128000,
+    'anthropic': 200000,
+    'google': 1048576,
+    'mistral': 32000,
+    'ollama': 8192,  # Sent to Ollama as num_ctx
+}
+
+# Hugging Face tokenizer used to count each provider's tokens (TOKENIZER_<PROVIDER>
+# may name another one or a local tokenizer.json); other providers are estimated
+PROVIDER_TOKENIZERS = {
+    'openai': 'Xenova/gpt-4o',
+    'anthropic': 'Xenova/claude-tokenizer',
+}
+# Tokenizers that only approximate the provider's count: there is no public
+# Claude 3 tokenizer, and the Claude 2 one differs from it
+APPROXIMATE_TOKENIZERS = ['anthropic']
+CHARS_PER_TOKEN = 3.5  # On the low side, so estimates rarely undercount
+PROMPT_OVERHEAD_TOKENS = 256  # Labels, role markers and system prompts
+
+# Parts are trimmed in this order until the prompt fits; the question itself never is
+TRIM_ORDER = ['context', 'history', 'file']
+
+_tokenizers = {}
+_lock = threading.Lock()
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN) if text else 0
+
+def get_tokenizer(dev):
+    name = os.environ.get(f"TOKENIZER_{dev.upper()}", PROVIDER_TOKENIZERS.get(dev))
+    if not name:
+        return None
+    with _lock:
+        if name not in _tokenizers:
+            try:
+                from tokenizers import Tokenizer
+                _tokenizers[name] = Tokenizer.from_file(name) if os.path.isfile(name) else Tokenizer.from_pretrained(name)
+            except Exception as e:
+                # Missing package, no network or unknown name; remembered so it is only tried once
+                print(f"Tokenizer {name} unavailable, estimating tokens instead: {str(e)}")
+                _tokenizers[name] = None
+        return _tokenizers[name]
+
+def context_limit(dev, model_name):
+    default = MODEL_CONTEXT_TOKENS.get(model_name, PROVIDER_CONTEXT_TOKENS.get(dev, 8192))
+    return int(os.environ.get(f"{dev.upper()}_CONTEXT_TOKENS", default))
+
+class TokenCounter:
+    """Counts tokens for one provider: exactly when its tokenizer is available and exact, estimated otherwise."""
+
+    def __init__(self, dev):
+        self.tokenizer = get_tokenizer(dev)
+        self.exact = self.tokenizer is not None and dev not in APPROXIMATE_TOKENIZERS
+
+    def count(self, text):
+        if not text:
+            return 0
+        if self.tokenizer:
+            return len(self.tokenizer.encode(text, add_special_tokens=False).ids)
+        return estimate_tokens(text)
+
+    def truncate(self, text, max_tokens, keep='start'):
+        # keep='start' cuts the end off; keep='end' cuts the beginning (the oldest history)
+        if max_tokens <= 0:
+            return ""
+        if self.count(text) <= max_tokens:
+            return text
+        if self.tokenizer:
+            offsets = self.tokenizer.encode(text, add_special_tokens=False).offsets
+            return text[:offsets[max_tokens - 1][1]] if keep == 'start' else text[offsets[-max_tokens][0]:]
+        chars = int(max_tokens * CHARS_PER_TOKEN)
+        return text[:chars] if keep == 'start' else text[-chars:]
+
+def fit_prompt(dev, model_name, max_tokens, parts):
+    """Trim prompt parts to fit the model's context window, keeping room for max_tokens of output.
+
+    parts maps a name to (text, keep): keep is which end survives trimming.
+    Parts named in TRIM_ORDER are trimmed in that order. Returns the texts by
+    name and a usage dict.
+    """
+    counter = TokenCounter(dev)
+    limit = context_limit(dev, model_name)
+    budget = max(0, limit - max_tokens - PROMPT_OVERHEAD_TOKENS)
+    texts = {name: text for name, (text, _) in parts.items()}
+    counts = {name: counter.count(text) for name, text in texts.items()}
+    total = sum(counts.values())
+    trimmed = []
+    for name in TRIM_ORDER:
+        if total <= budget:
+            break
+        if name not in parts or not counts[name]:
+            continue
+        _, keep = parts[name]
+        allowed = max(0, counts[name] - (total - budget))
+        texts[name] = counter.truncate(texts[name], allowed, keep)
+        new_count = counter.count(texts[name])
+        total -= counts[name] - new_count
+        counts[name] = new_count
+        trimmed.append(name)
+    usage = {
+        "provider": dev,
+        "model": model_name,
+        "exact": counter.exact,
+        "limit": limit,
+        "max_tokens": max_tokens,
+        "prompt_tokens": total,
+        "parts": counts,
+        "trimmed": trimmed,
+        "fits": total <= budget,
+    }
+    return texts, usage
+
+def format_usage(usage):
+    counted = "" if usage["exact"] else "~"
+    parts = ", ".join(f"{name} {count:,}" for name, count in usage["parts"].items() if count)
+    text = f"{counted}{usage['prompt_tokens']:,} prompt tokens of {usage['limit']:,} ({parts})"
+    if usage["trimmed"]:
+        text += f"; trimmed {', '.join(usage['trimmed'])} to fit"
+    if usage.get("prompt_cache"):
+        text += f"; {usage['prompt_cache']}"
+    if usage.get("prefix_match"):
+        text += f"; {format_prefix_match(usage['prefix_match'])}"
+    return text